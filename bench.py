@@ -0,0 +1,685 @@
+"""
+Benchmarks for plume hot paths.
+
+Run with `python bench.py`. Each benchmark compares a fast code path
+against the slower path it replaces and prints the best-of-n wall time.
+
+Run with `python bench.py --suite` to instead time the hot paths (and measure
+their peak memory) on small, medium and large grids. Use `--save results.json`
+to store the results and `--baseline results.json` to compare a later run
+against them.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+import tracemalloc
+import numpy as np
+
+import plume
+import logprob_odor
+import searchers
+import sweep
+
+
+def make_env(nx=100, ny=40, nz=40):
+    """Make a unit-ish environment with the given number of voxels per axis."""
+    xbins = np.linspace(-0.3, 1.0, nx + 1)
+    ybins = np.linspace(-0.15, 0.15, ny + 1)
+    zbins = np.linspace(-0.15, 0.15, nz + 1)
+    return plume.Environment3d(xbins, ybins, zbins)
+
+
+def best_time(func, repeat=5, number=1):
+    """Return best wall time (s) of calling func over several repeats."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def peak_memory(func):
+    """Return the result of calling func and the peak memory (bytes) allocated during the call."""
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, peak
+
+
+def make_plumes(env):
+    """Make one initializable plume of each type."""
+    pl_empty = plume.EmptyPlume(env)
+
+    pl_collimated = plume.CollimatedPlume(env)
+    pl_collimated.set_params(max_conc=488, threshold=450, ymean=0.0105, zmean=0.0213, ystd=.0073, zstd=.0094)
+
+    pl_spreading = plume.SpreadingGaussianPlume(env)
+    pl_spreading.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                            alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                            x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                            bkgd=400, threshold=450)
+
+    pl_basic = plume.BasicPlume(env)
+    pl_basic.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+    pl_basic.set_src_pos((0., 0., 0.))
+
+    pl_collimated_poisson = plume.CollimatedPoissonPlume(env)
+    pl_collimated_poisson.set_aux_params(width=.01, peak=100, max_hit_number=1)
+    pl_collimated_poisson.set_src_pos((0., 0., 0.))
+
+    pl_puff = make_puff_plume(env)
+
+    return [pl_empty, pl_collimated, pl_spreading, pl_basic, pl_collimated_poisson, pl_puff]
+
+
+def make_puff_plume(env, n_puffs=20000, seed=0):
+    """Make a puff plume that releases puffs at the upwind edge of the environment,
+    reaching about n_puffs in steady state."""
+    pl = plume.PuffPlume(env, dt=.01, seed=seed)
+    pl.set_params(w=0.4, release_rate=n_puffs / 3., q=1, d=0.0001, sigma_0=.005, wander=0.0005,
+                  max_puffs=n_puffs)
+    pl.set_src_pos((env.xbins[0], 0., 0.))
+
+    return pl
+
+
+def report(name, t_scalar, t_vector):
+    print('{:<40s} scalar {:10.2e}s  vector {:10.2e}s  speedup {:8.1f}x'.format(
+        name, t_scalar, t_vector, t_scalar / t_vector))
+
+
+def import_time(module, repeat=5):
+    """Return best cumulative import time (s) of module in a fresh interpreter, as
+    reported by `python -X importtime`, not counting NumPy (which is imported first)."""
+    times = []
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import numpy; import ' + module],
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+        for line in stderr.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                times += [int(fields[1]) / 1e6]
+
+    return min(times)
+
+
+def bench_import_time(threshold=0.05):
+    """Compare the cold import time of plume (beyond NumPy) to that of scipy.stats,
+    which it used to import, and flag a regression if it exceeds threshold (s)."""
+    t_scipy = import_time('scipy.stats')
+    t_plume = import_time('plume')
+
+    report('import plume vs import scipy.stats', t_scipy, t_plume)
+    if t_plume > threshold:
+        print('{:<40s} REGRESSION: import plume took {:.3f}s > {:.3f}s'.format('', t_plume, threshold))
+
+    return t_plume <= threshold
+
+
+def bench_idxs_from_positions(n_positions=100000):
+    env = make_env()
+    positions = np.random.uniform(-0.4, 1.1, (n_positions, 3)) * [1, .3, .3]
+
+    t_scalar = best_time(lambda: [env.idx_from_pos(pos) for pos in positions], repeat=3)
+    t_vector = best_time(lambda: env.idxs_from_positions(positions))
+
+    report('idxs_from_positions (N={})'.format(n_positions), t_scalar, t_vector)
+
+
+def bench_idxs_out_of_bounds(n_positions=100000):
+    env = make_env()
+    pos_idxs = np.random.randint(-5, 105, (n_positions, 3))
+
+    t_scalar = best_time(lambda: [env.idx_out_of_bounds(pos_idx) for pos_idx in pos_idxs], repeat=3)
+    t_vector = best_time(lambda: env.idxs_out_of_bounds(pos_idxs))
+
+    report('idxs_out_of_bounds (N={})'.format(n_positions), t_scalar, t_vector)
+
+
+def bench_discretize_position_sequence(n_positions=20000):
+    env = make_env()
+    positions = np.array([0.35, 0, 0]) + np.random.normal(0, .005, (n_positions, 3)).cumsum(axis=0)
+
+    def discretize_scalar():
+        # the original per-chunk / per-element implementation
+        idxs = np.array([env.idx_from_pos(pos) for pos in positions])
+        l1_dists = np.abs(np.diff(idxs, axis=0)).sum(axis=1)
+        chunks = np.split(idxs, (l1_dists > 1).nonzero()[0] + 1)
+        connectors = [env.diagonalest_lattice_path(chunk[-1], next_chunk[0])
+                      for chunk, next_chunk in zip(chunks[:-1], chunks[1:])]
+        temp_idxs = [None] * (len(chunks) + len(connectors))
+        temp_idxs[::2] = chunks
+        temp_idxs[1::2] = connectors
+        temp_idxs = np.concatenate(temp_idxs)
+        final_idxs = [temp_idxs[0]]
+        for temp_idx in temp_idxs[1:]:
+            if not np.all(temp_idx == final_idxs[-1]):
+                final_idxs += [temp_idx]
+        return final_idxs
+
+    t_scalar = best_time(discretize_scalar, repeat=3)
+    t_vector = best_time(lambda: env.discretize_position_sequence(positions))
+
+    report('discretize_position_sequence (N={})'.format(n_positions), t_scalar, t_vector)
+
+
+def bench_sample_many(n_samples=20000):
+    env = make_env()
+    pl = plume.BasicPlume(env)
+    pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+    pl.set_src_pos((0., 0., 0.))
+    pl.initialize()
+
+    pos_idxs = np.array([np.random.randint(0, n, (n_samples,)) for n in env.shape]).T
+
+    t_scalar = best_time(lambda: [pl.sample(pos_idx) for pos_idx in pos_idxs], repeat=3)
+    t_vector = best_time(lambda: pl.sample_many(pos_idxs))
+
+    report('BasicPlume.sample_many (N={})'.format(n_samples), t_scalar, t_vector)
+
+
+def bench_binary_advec_diff_tavg_cached(n_obs=50):
+    env = make_env()
+    params = {'dt': .1, 'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    pos_idxs = np.array([np.random.randint(0, n, (n_obs,)) for n in env.shape]).T
+
+    def run_direct():
+        for pos_idx in pos_idxs:
+            logprob_odor.binary_advec_diff_tavg(1, pos_idx, env.x, env.y, env.z, **params)
+
+    def run_cached():
+        for pos_idx in pos_idxs:
+            logprob_odor.binary_advec_diff_tavg_cached(1, pos_idx, env.x, env.y, env.z, **params)
+
+    # build the kernel once so that only cache hits are timed
+    run_cached()
+
+    t_scalar = best_time(run_direct, repeat=3)
+    t_vector = best_time(run_cached)
+
+    report('binary_advec_diff_tavg_cached (T={})'.format(n_obs), t_scalar, t_vector)
+
+
+def bench_binary_advec_diff_tavg_fft(n_obs=2000):
+    env = make_env(50, 20, 20)
+    params = {'dt': .1, 'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    pos_idxs = np.array([np.random.randint(0, n, (n_obs,)) for n in env.shape]).T
+    odors = np.random.randint(0, 2, (n_obs,))
+
+    def run_summed():
+        log_like = np.zeros(env.shape)
+        for pos_idx, odor in zip(pos_idxs, odors):
+            log_like += logprob_odor.binary_advec_diff_tavg_cached(odor, pos_idx, env.x, env.y, env.z, **params)
+        return log_like
+
+    def run_fft():
+        hit_counts, miss_counts = logprob_odor.hit_miss_counts(pos_idxs, odors, env.shape)
+        return logprob_odor.binary_advec_diff_tavg_fft(hit_counts, miss_counts, env.x, env.y, env.z, **params)
+
+    # build the kernel and its FFTs once so that only cache hits are timed
+    run_fft()
+
+    t_scalar = best_time(run_summed, repeat=3)
+    t_vector = best_time(run_fft)
+
+    report('binary_advec_diff_tavg_fft (T={})'.format(n_obs), t_scalar, t_vector)
+
+
+def bench_logk0(n=1000000):
+    from scipy.special import k0
+
+    x = np.random.uniform(0, 50, (n,))
+
+    t_scalar = best_time(lambda: np.log(k0(x)))
+    t_vector = best_time(lambda: logprob_odor.logk0(x))
+
+    report('logk0 (N={}) vs log(k0)'.format(n), t_scalar, t_vector)
+
+
+def bench_binary_advec_diff_log_probs():
+    env = make_env(200, 80, 80)
+    p = {'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    dx, dy, dz = np.meshgrid(env.x, env.y, env.z, indexing='ij', sparse=True)
+
+    def run_naive():
+        mean_hit_num = .1 * logprob_odor.advec_diff_mean_hit_rate(dx, dy, dz, **p)
+        return logprob_odor.binary_log_probs(mean_hit_num)
+
+    lhit = np.empty(env.shape)
+    lmiss = np.empty(env.shape)
+
+    def run_fused():
+        return logprob_odor.binary_advec_diff_log_probs(dx, dy, dz, .1, lhit=lhit, lmiss=lmiss, **p)
+
+    with np.errstate(divide='ignore'):
+        t_scalar = best_time(run_naive, repeat=3)
+        t_vector = best_time(run_fused, repeat=3)
+        _, peak_naive = peak_memory(run_naive)
+        _, peak_fused = peak_memory(run_fused)
+
+    report('binary_advec_diff_log_probs (fused)', t_scalar, t_vector)
+    print('{:<40s} peak naive {:8.1f} MB  fused (with out=) {:8.1f} MB'.format('', peak_naive / 1e6, peak_fused / 1e6))
+
+
+def bench_initialize_memory():
+    env = make_env(200, 80, 80)
+
+    # (puff plumes have no static field)
+    for pl in make_plumes(env)[:5]:
+        _, peak = peak_memory(pl.initialize)
+        print('{:<40s} peak {:8.1f} MB  field {:8.1f} MB  ratio {:5.2f}'.format(
+            type(pl).__name__ + '.initialize', peak / 1e6, pl.conc.nbytes / 1e6, peak / pl.conc.nbytes))
+
+
+def bench_sparse_storage(n_samples=100000):
+    env = make_env(200, 80, 80)
+    pos_idxs = np.array([np.random.randint(0, n, (n_samples,)) for n in env.shape]).T
+
+    for storage in ('dense', 'box', 'block'):
+        for pl in make_plumes(env)[2:5]:
+            pl.set_storage(storage, tol=1.)
+            with np.errstate(divide='ignore'):
+                t_init = best_time(pl.initialize, repeat=1)
+                _, peak = peak_memory(pl.initialize)
+            t_sample = best_time(lambda: pl.sample_many(pos_idxs))
+
+            print('{:<40s} field {:8.2f} MB  init peak {:8.2f} MB  init {:8.2e}s  sample_many (N={}) {:8.2e}s'.format(
+                '{} ({})'.format(type(pl).__name__, storage), pl.conc.nbytes / 1e6, peak / 1e6, t_init,
+                n_samples, t_sample))
+
+
+def bench_analytic_storage(n_samples=100000, cache_size=2**14):
+    # sparse queries: a random walk that keeps revisiting nearby voxels
+    env = make_env(200, 80, 80)
+    steps = np.random.randint(-1, 2, (n_samples, 3))
+    pos_idxs = np.clip(np.array(env.shape) // 2 + steps.cumsum(axis=0), 0, np.array(env.shape) - 1)
+
+    for storage, size in (('dense', 0), ('analytic', 0), ('analytic', cache_size)):
+        for pl in make_plumes(env)[2:4]:
+            pl.set_storage(storage, cache_size=size)
+            with np.errstate(divide='ignore'):
+                t_init = best_time(pl.initialize, repeat=1)
+                _, peak = peak_memory(pl.initialize)
+            t_sample = best_time(lambda: pl.sample_many(pos_idxs))
+
+            nbytes = pl.conc.nbytes if isinstance(pl.conc, plume.sparse_field.SparseField) else np.asarray(pl.conc).nbytes
+            print('{:<48s} field {:8.2f} MB  init peak {:8.2f} MB  init {:8.2e}s  sample_many (N={}) {:8.2e}s'.format(
+                '{} ({}, cache {})'.format(type(pl).__name__, storage, size), nbytes / 1e6, peak / 1e6, t_init,
+                n_samples, t_sample))
+
+    # a domain far too large to store (10^12 voxels)
+    env = make_env(10000, 10000, 10000)
+    pos_idxs = np.array([np.random.randint(0, n, (n_samples,)) for n in env.shape]).T
+    pl = make_plumes(env)[3]
+    pl.set_storage('analytic')
+    _, peak = peak_memory(pl.initialize)
+    t_sample = best_time(lambda: pl.sample_many(pos_idxs))
+    print('{:<48s} init peak {:8.2f} MB  sample_many (N={}) {:8.2e}s'.format(
+        'BasicPlume (analytic, 10^12 voxels)', peak / 1e6, n_samples, t_sample))
+
+
+def bench_detection_map(n_samples=1000000):
+    env = make_env(200, 80, 80)
+    pl = make_plumes(env)[2]
+    pl.initialize()
+    pos_idxs = np.array([np.random.randint(0, n, (n_samples,)) for n in env.shape]).T
+
+    t_scalar = best_time(lambda: (pl.conc_at_idxs(pos_idxs) > pl.threshold).astype(int))
+    t_vector = best_time(lambda: pl.sample_many(pos_idxs))
+
+    report('detection map sample_many (N={})'.format(n_samples), t_scalar, t_vector)
+    print('{:<40s} field {:8.2f} MB  detection map {:8.2f} MB'.format(
+        '', pl.conc.nbytes / 1e6, pl.detection_map.nbytes / 1e6))
+
+
+def bench_refined_grid(n_positions=200000):
+    p = {'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    rng = np.random.default_rng(0)
+
+    # half the positions anywhere, half near the source, where gradients are steep
+    positions = np.concatenate([rng.uniform([-0.3, -0.15, -0.15], [1.0, 0.15, 0.15], (n_positions // 2, 3)),
+                                rng.uniform([-0.05, -0.05, -0.05], [0.2, 0.05, 0.05], (n_positions // 2, 3))])
+    true_rate = logprob_odor.advec_diff_mean_hit_rate(positions[:, 0], positions[:, 1], positions[:, 2], **p)
+
+    envs = {'uniform': make_env(104, 24, 24),
+            'refined': plume.Environment3d.refined((-0.3, 1.0), (-0.15, 0.15), (-0.15, 0.15), (0., 0., 0.),
+                                                   min_width=.005, max_width=.05, growth=1.4)}
+
+    for name, env in envs.items():
+        pl = plume.BasicPlume(env)
+        pl.set_params(**p)
+        pl.set_src_pos((0., 0., 0.))
+        with np.errstate(divide='ignore'):
+            t_init = best_time(pl.initialize, repeat=3)
+
+        rate = pl.conc_at_idxs(env.idxs_from_positions(positions))
+        finite = np.isfinite(rate)
+        error = np.mean(np.abs(np.log(rate[finite] / true_rate[finite])))
+
+        print('{:<40s} voxels {:8d}  initialize {:8.2e}s  mean abs log error {:6.3f}'.format(
+            'BasicPlume on {} grid {}'.format(name, env.shape), int(np.prod(env.shape)), t_init, error))
+
+
+def bench_interpolation(n_positions=100000):
+    p = {'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    rng = np.random.default_rng(0)
+
+    # positions downwind of the source, but not right next to it
+    positions = rng.uniform([0.05, -0.1, -0.1], [1.0, 0.1, 0.1], (n_positions, 3))
+
+    for shape in ((52, 12, 12), (104, 24, 24), (208, 48, 48)):
+        env = make_env(*shape)
+        pl = plume.BasicPlume(env)
+        pl.set_params(**p)
+        pl.set_src_pos((0., 0., 0.))
+        with np.errstate(divide='ignore'):
+            pl.initialize()
+
+        # (the source is moved to the center of the voxel it's in)
+        disp = positions - pl.src_pos
+        true_rate = logprob_odor.advec_diff_mean_hit_rate(disp[:, 0], disp[:, 1], disp[:, 2], **p)
+
+        nearest = pl.conc_at_idxs(env.idxs_from_positions(positions))
+        t_interp = best_time(lambda: pl.conc_at(positions))
+        interp = pl.conc_at(positions)
+
+        print('{:<40s} nearest error {:8.1e}  interpolated error {:8.1e}  conc_at (N={}) {:8.2e}s'.format(
+            'BasicPlume on grid {}'.format(shape), np.mean(np.abs(np.log(nearest / true_rate))),
+            np.mean(np.abs(np.log(interp / true_rate))), n_positions, t_interp))
+
+
+def bench_puff_plume(n_puffs=20000, n_agents=1000):
+    env = make_env()
+    pl = make_puff_plume(env, n_puffs)
+    pl.initialize()
+
+    # fill the plume up to capacity
+    while pl.n_puffs < n_puffs:
+        pl.update()
+
+    pos_idxs = np.array([np.random.randint(0, n, (n_agents,)) for n in env.shape]).T
+
+    t_update = best_time(pl.update, number=10)
+    t_sample = best_time(lambda: pl.sample_many(pos_idxs))
+    t_rasterize = best_time(pl.rasterize, repeat=3)
+
+    print('{:<40s} update {:10.2e}s ({:.0f} steps/s)  sample_many (N={}) {:10.2e}s  rasterize {:10.2e}s'.format(
+        'PuffPlume ({} puffs)'.format(pl.n_puffs), t_update, 1 / t_update, n_agents, t_sample, t_rasterize))
+
+
+def bench_searcher_population(n_agents=100000, n_steps=20):
+    env = make_env()
+    pl = plume.BasicPlume(env)
+    pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+    pl.set_src_pos((0., 0., 0.))
+    pl.initialize()
+
+    start_pos_idxs = np.array([np.random.randint(0, n, (n_agents,)) for n in env.shape]).T
+
+    def run_population():
+        pop = searchers.SearcherPopulation(pl, n_agents, n_steps, rule=searchers.surge_cast_rule, seed=0)
+        pop.reset(start_pos_idxs)
+        pop.run()
+
+    def run_one_at_a_time():
+        # per-agent loop over a hundredth of the agents
+        for pos_idx in start_pos_idxs[:n_agents // 100]:
+            pos_idx = pos_idx.copy()
+            for _ in range(n_steps):
+                odor = pl.sample(pos_idx)
+                pos_idx += [-1, 0, 0] if odor else [0, np.random.choice([-1, 1]), 0]
+                if env.idx_out_of_bounds(pos_idx):
+                    break
+
+    t_scalar = 100 * best_time(run_one_at_a_time, repeat=1)
+    t_vector = best_time(run_population, repeat=3)
+
+    report('SearcherPopulation (N={}, T={})'.format(n_agents, n_steps), t_scalar, t_vector)
+    print('{:<40s} {:.2e} agent-steps/s'.format('', n_agents * n_steps / t_vector))
+
+
+def bench_sweep(n_points=16):
+    env = make_env()
+    param_points = sweep.param_grid(plume_name=['basic'], w=list(np.linspace(0.1, 1.0, n_points // 2)),
+                                    r=[10, 100], d=[0.1], a=[.002], tau=[1000], n_samples=[100000])
+
+    def run(max_workers):
+        for _ in sweep.run_sweep(sweep.plume_sampling_task, param_points, env, max_workers=max_workers):
+            pass
+
+    n_cpus = os.cpu_count() or 1
+    t_serial = best_time(lambda: run(1), repeat=1)
+    t_parallel = best_time(lambda: run(n_cpus), repeat=1)
+
+    report('run_sweep ({} points, 1 vs {} workers)'.format(n_points, n_cpus), t_serial, t_parallel)
+
+
+def bench_instrumentation_overhead(n_samples=100000, max_ratio=1.1, rounds=5):
+    import instrumentation
+
+    env = make_env()
+    pl = make_plumes(env)[3]
+    pl.initialize()
+    pos_idx = (50, 20, 20)
+    original_sample = type(pl).sample
+
+    def run():
+        # many short repeats, since the best of them is the least noisy
+        return 20 * best_time(lambda: [pl.sample(pos_idx) for _ in range(n_samples // 20)], repeat=20)
+
+    # alternate rounds before & after an enable/disable cycle, so that both see the
+    # same machine noise
+    t_original = t_disabled = t_enabled = np.inf
+    for _ in range(rounds):
+        t_original = min(t_original, run())
+
+        instrumentation.enable()
+        t_enabled = min(t_enabled, run())
+        instrumentation.disable()
+
+        # disabling restores the original methods
+        assert type(pl).sample is original_sample
+        t_disabled = min(t_disabled, run())
+
+    instrumentation.reset()
+
+    print('{:<40s} original {:10.2e}s  disabled {:10.2e}s  enabled {:10.2e}s'.format(
+        'instrumented BasicPlume.sample (N={})'.format(n_samples), t_original, t_disabled, t_enabled))
+    assert t_disabled < max_ratio * t_original, 'disabled instrumentation costs {:.0%}'.format(
+        t_disabled / t_original - 1)
+
+
+GRID_SIZES = {'small': (50, 20, 20), 'medium': (100, 40, 40), 'large': (200, 80, 80)}
+
+
+def measure(func, repeat=5):
+    """Return best wall time (s) and peak memory (bytes) of calling func, after a
+    warm-up call (which triggers lazy imports and caches). Fast functions are called
+    enough times per repeat to take at least 0.2s, so that timings are comparable
+    between runs."""
+    func()
+    _, peak = peak_memory(func)
+    number, _ = timeit.Timer(func).autorange()
+    return {'time': best_time(func, repeat=repeat, number=number), 'peak_memory': peak}
+
+
+def suite_benchmarks(env, n_samples=10000, n_positions=10000):
+    """Return a dict of benchmark functions for the hot paths on an environment.
+
+    Inputs are drawn from a fixed seed, so that results saved from one run can be
+    compared with another run on the same inputs."""
+    benchmarks = {}
+    rng = np.random.default_rng(0)
+
+    for pl in make_plumes(env):
+        benchmarks[type(pl).__name__ + '.initialize'] = pl.initialize
+
+    pl = make_plumes(env)[3]
+    pl.set_seed(0)
+    pl.initialize()
+    pos_idxs = np.array([rng.integers(0, n, (n_samples,)) for n in env.shape]).T
+    benchmarks['BasicPlume.sample'] = lambda: pl.sample(pos_idxs[0])
+    benchmarks['BasicPlume.sample_many'] = lambda: pl.sample_many(pos_idxs)
+
+    positions = np.array([0.35, 0, 0]) + rng.normal(0, .005, (n_positions, 3)).cumsum(axis=0)
+    benchmarks['discretize_position_sequence'] = lambda: env.discretize_position_sequence(positions)
+    benchmarks['diagonalest_lattice_path'] = lambda: env.diagonalest_lattice_path((0, 0, 0), env.max_idxs)
+
+    p = {'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+    dx, dy, dz = np.meshgrid(env.x, env.y, env.z, indexing='ij', sparse=True)
+    benchmarks['advec_diff_mean_hit_rate (3D)'] = lambda: logprob_odor.advec_diff_mean_hit_rate(dx, dy, dz, **p)
+    benchmarks['advec_diff_mean_hit_rate (2D)'] = lambda: logprob_odor.advec_diff_mean_hit_rate(
+        dx[..., 0], dy[..., 0], 0., dim=2, **p)
+
+    center_idx = tuple(n // 2 for n in env.shape)
+    benchmarks['binary_advec_diff_tavg'] = lambda: logprob_odor.binary_advec_diff_tavg(
+        1, center_idx, env.x, env.y, env.z, dt=.1, **p)
+
+    # the puff plume changes every step, so it's benchmarked at its steady state
+    pl_puff = make_puff_plume(env, n_puffs=5000)
+    pl_puff.initialize()
+    while pl_puff.n_puffs < 5000:
+        pl_puff.update()
+    benchmarks['PuffPlume.update'] = pl_puff.update
+    benchmarks['PuffPlume.sample_many'] = lambda: pl_puff.sample_many(pos_idxs[:1000])
+    benchmarks['PuffPlume.rasterize'] = pl_puff.rasterize
+
+    return benchmarks
+
+
+def run_suite(sizes=tuple(GRID_SIZES), repeat=5, names=None):
+    """Run the benchmark suite on the given grid sizes.
+
+    Args:
+        sizes: grid sizes (keys of GRID_SIZES)
+        repeat: number of timing repeats, the best of which is kept
+        names: optional dict of the names of the benchmarks to run by grid size
+            (defaults to all of them)
+
+    Returns:
+        dict of {'time': ..., 'peak_memory': ...} dicts by grid size and benchmark name"""
+    results = {}
+
+    for size in sizes:
+        env = make_env(*GRID_SIZES[size])
+        results[size] = {}
+
+        with np.errstate(divide='ignore'):
+            for name, func in suite_benchmarks(env).items():
+                if names is not None and name not in names.get(size, ()):
+                    continue
+                results[size][name] = measure(func, repeat=repeat)
+                print('{:<8s} {:<40s} time {:10.2e}s  peak {:8.2f} MB'.format(
+                    size, name, results[size][name]['time'], results[size][name]['peak_memory'] / 1e6))
+
+    return results
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(results, baseline, tolerance=1.5):
+    """Print the ratio of each result to the baseline, flagging ones that got more than
+    tolerance times slower or bigger.
+
+    Returns:
+        list of (size, name, quantity, ratio) tuples for the regressions"""
+    regressions = []
+
+    for size, size_results in sorted(results.items()):
+        for name, result in sorted(size_results.items()):
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+
+            ratios = {quantity: result[quantity] / max(base[quantity], 1e-12) for quantity in result}
+            flags = [quantity for quantity, ratio in sorted(ratios.items()) if ratio > tolerance]
+            regressions += [(size, name, quantity, ratios[quantity]) for quantity in flags]
+
+            print('{:<8s} {:<40s} time {:6.2f}x  peak {:6.2f}x  {}'.format(
+                size, name, ratios['time'], ratios['peak_memory'], 'REGRESSION' if flags else ''))
+
+    return regressions
+
+
+def confirm_regressions(results, baseline, tolerance=1.5, n_retries=2, repeat=10):
+    """Compare results with the baseline, re-measuring the benchmarks that look like
+    regressions (keeping their best time over all runs) before reporting them, since
+    a single noisy run can easily be 1.5x slower.
+
+    Returns:
+        list of (size, name, quantity, ratio) tuples for the confirmed regressions,
+        with results updated in place"""
+    regressions = compare_results(results, baseline, tolerance)
+
+    for _ in range(n_retries):
+        if not regressions:
+            break
+
+        print('re-measuring {} possible regressions'.format(len(regressions)))
+        names = {}
+        for size, name, _, _ in regressions:
+            names.setdefault(size, set()).add(name)
+
+        remeasured = run_suite(sorted(names), repeat=repeat, names=names)
+        for size, size_results in remeasured.items():
+            for name, result in size_results.items():
+                for quantity, value in result.items():
+                    results[size][name][quantity] = min(results[size][name][quantity], value)
+
+        regressions = compare_results(results, baseline, tolerance)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', action='store_true', help='run the benchmark suite across grid sizes')
+    parser.add_argument('--sizes', nargs='+', default=list(GRID_SIZES), choices=list(GRID_SIZES))
+    parser.add_argument('--save', help='JSON file to save suite results to')
+    parser.add_argument('--baseline', help='JSON file of suite results to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown or memory growth relative to baseline that counts as a regression')
+    args = parser.parse_args()
+
+    if args.suite:
+        results = run_suite(args.sizes)
+        regressions = []
+        if args.baseline:
+            regressions = confirm_regressions(results, load_results(args.baseline), args.tolerance)
+        if args.save:
+            save_results(results, args.save)
+        sys.exit(1 if regressions else 0)
+    else:
+        bench_import_time()
+        bench_idxs_from_positions()
+        bench_idxs_out_of_bounds()
+        bench_discretize_position_sequence()
+        bench_sample_many()
+        bench_binary_advec_diff_tavg_cached()
+        bench_binary_advec_diff_tavg_fft()
+        bench_logk0()
+        bench_binary_advec_diff_log_probs()
+        bench_initialize_memory()
+        bench_instrumentation_overhead()
+        bench_sparse_storage()
+        bench_analytic_storage()
+        bench_detection_map()
+        bench_refined_grid()
+        bench_interpolation()
+        bench_puff_plume()
+        bench_searcher_population()
+        bench_sweep()
@@ -0,0 +1,152 @@
+"""
+Persistent on-disk cache of initialized plume fields.
+
+Fields are stored as .npy files keyed by a hash of everything that determines
+them (plume type, params, source position idx, dtype, storage and environment bins) and
+loaded memory-mapped and read-only, so that many processes using the same plume
+share the same pages.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import sparse_field
+
+
+class FieldCache(object):
+    """Size-bounded cache of plume fields in a local directory.
+
+    Files are written to a temporary file and atomically renamed into place, so
+    concurrent writers never expose partial files, and readers that lose a race
+    with eviction just recompute the field. When the total size of the cache
+    exceeds max_bytes the least recently used fields are deleted (processes that
+    already have them memory-mapped keep their pages until they let go of them).
+
+    Args:
+        directory: directory to store fields in (created if it doesn't exist)
+        max_bytes: maximum total size of stored fields
+    """
+
+    version = 2
+
+    def __init__(self, directory, max_bytes=2**32):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, plume):
+        """Return a hash of everything that determines a plume's field."""
+        env = plume.env
+        h = hashlib.sha1()
+
+        # lossy sparse storage (tol > 0) gives a different field than dense storage
+        storage = (getattr(plume, 'storage', 'dense'), getattr(plume, 'storage_tol', 0.),
+                   tuple(getattr(plume, 'block_shape', ())))
+
+        h.update(repr((self.version, getattr(plume, 'name', type(plume).__name__),
+                       sorted(plume.params.items()), plume.src_pos_idx,
+                       plume.dtype.str, storage)).encode())
+
+        for bins in (env.xbins, env.ybins, env.zbins):
+            h.update(np.ascontiguousarray(bins, dtype=float).tobytes())
+            h.update(b'|')
+
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        """Return the memory-mapped field stored under key, or None if there isn't one."""
+        path = self.path(key)
+
+        try:
+            conc = np.load(path, mmap_mode='r')
+            # mark as recently used
+            os.utime(path)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return conc
+
+    def save(self, key, conc):
+        """Store a field under key and evict old fields if the cache is too big."""
+        if conc is None:
+            raise ValueError('There is no field to cache!')
+        if isinstance(conc, sparse_field.AnalyticField):
+            # storing it would take evaluating the whole grid
+            raise ValueError('Analytic fields cannot be cached!')
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(conc))
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Delete least recently used fields until the cache fits in max_bytes."""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.npy') or file_name[:-4] == keep:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                # another process got rid of it
+                continue
+            entries += [(stat.st_mtime, stat.st_size, file_name)]
+
+        total_bytes = sum(entry[1] for entry in entries)
+        if keep is not None and os.path.exists(self.path(keep)):
+            total_bytes += os.path.getsize(self.path(keep))
+
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def initialize(self, plume):
+        """Initialize a plume, loading its field from the cache if possible and
+        otherwise calculating and storing it. Either way the plume ends up with a
+        read-only memory-mapped field.
+
+        Plumes with non-dense storage (see Plume.set_storage) are just initialized,
+        since caching them would replace their field with a dense one (and analytic
+        fields would have to be evaluated over the whole grid to be stored), as are
+        plumes without a static field (e.g. PuffPlume, whose conc is None until it's
+        rasterized)."""
+        if getattr(plume, 'storage', 'dense') != 'dense':
+            plume.initialize()
+            return plume
+
+        key = self.key(plume)
+
+        conc = self.load(key)
+        if conc is None:
+            plume.initialize()
+            if plume.conc is None:
+                return plume
+
+            self.save(key, plume.conc)
+            conc = self.load(key)
+
+        # fall back on the calculated field if it was evicted immediately
+        if conc is not None:
+            plume.load_field(conc)
+
+        return plume
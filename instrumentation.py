@@ -0,0 +1,172 @@
+"""
+Opt-in instrumentation of plume hot paths.
+
+Plume.initialize/sample/sample_many/update, Environment3d.discretize_position_sequence
+and the logprob_odor kernels are wrapped so that, once enable() has been called,
+every call is counted and timed. stats() returns a snapshot of the totals, and an
+optional callback receives each call as it finishes (e.g. to forward it to a
+metrics collector). The timing wrappers are only installed by enable() and are
+removed again by disable(), so while disabled the instrumented functions and methods
+are the originals and cost nothing extra. (Functions are wrapped where their module
+defines them, so callers must look them up through the module, e.g.
+logprob_odor.binary_advec_diff_log_probs, for their calls to be recorded.)
+
+Example:
+    instrumentation.enable()
+    pl.initialize()
+    pl.sample_many(pos_idxs)
+    print(instrumentation.stats())
+"""
+
+import functools
+import sys
+import time
+
+_enabled = False
+_callback = None
+
+# call count & total wall time (s) by name
+_stats = {}
+
+# (owner, attribute name, original, name to record under or None for methods) of
+# everything that is wrapped while enabled; the owner of a function is the name of
+# its module, since the module is still being imported when it's registered
+_targets = []
+
+
+def _timed(func, name):
+    """Return a wrapper of func recording its calls under name."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _timed_method(method):
+    """Return a wrapper of method recording its calls under the name of the class of
+    the instance it is called on (e.g. 'BasicPlume.update' even if update is inherited
+    from Plume)."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            record(type(self).__name__ + '.' + method.__name__, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _owner(owner):
+    return sys.modules[owner] if isinstance(owner, str) else owner
+
+
+def _install(target):
+    owner, attr, original, name = target
+    setattr(_owner(owner), attr, _timed_method(original) if name is None else _timed(original, name))
+
+
+def enable(callback=None):
+    """Start counting and timing calls.
+
+    Args:
+        callback: optional function called as callback(name, elapsed) after every
+            instrumented call, with elapsed its wall time in seconds
+    """
+    global _enabled, _callback
+    _callback = callback
+
+    if not _enabled:
+        for target in _targets:
+            _install(target)
+
+    _enabled = True
+
+
+def disable():
+    """Stop counting and timing calls (stats collected so far are kept)."""
+    global _enabled, _callback
+
+    if _enabled:
+        for owner, attr, original, _ in _targets:
+            setattr(_owner(owner), attr, original)
+
+    _enabled = False
+    _callback = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Clear all collected stats."""
+    _stats.clear()
+
+
+def stats():
+    """Return a snapshot of the collected stats.
+
+    Returns:
+        dict of {'calls': number of calls, 'time': total wall time (s)} dicts by name,
+        e.g. 'BasicPlume.initialize' or 'logprob_odor.binary_advec_diff_tavg'
+    """
+    return {name: {'calls': calls, 'time': total} for name, (calls, total) in _stats.items()}
+
+
+def record(name, elapsed):
+    """Add a call of the given wall time to the stats and pass it to the callback."""
+    calls, total = _stats.get(name, (0, 0.))
+    _stats[name] = (calls + 1, total + elapsed)
+
+    if _callback is not None:
+        _callback(name, elapsed)
+
+
+def instrumented(name):
+    """Decorator registering a module-level function to be counted and timed under
+    name while enabled (it is returned unchanged)."""
+    def decorator(func):
+        _targets.append((func.__module__, func.__name__, func, name))
+        return func
+
+    return decorator
+
+
+class _InstrumentedMethod(object):
+    """Placeholder that registers the method it holds with the class it is defined in,
+    then replaces itself with the method."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __set_name__(self, owner, attr):
+        setattr(owner, attr, self.func)
+        instrument_methods(owner, (attr,))
+
+
+def instrumented_method(func):
+    """Decorator registering a method to be counted and timed while enabled, under the
+    name of the class of the instance it is called on (the method itself is left
+    unchanged)."""
+    return _InstrumentedMethod(func)
+
+
+def instrument_methods(cls, method_names):
+    """Register the methods with the given names that cls itself defines to be
+    counted and timed while enabled (methods it inherits are left alone, since they
+    are registered where they are defined)."""
+    for method_name in method_names:
+        method = cls.__dict__.get(method_name)
+        if not callable(method) or any(owner is cls and attr == method_name for owner, attr, _, _ in _targets):
+            continue
+
+        target = (cls, method_name, method, None)
+        _targets.append(target)
+        if _enabled:
+            _install(target)
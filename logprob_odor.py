@@ -6,13 +6,49 @@ Created on Fri Dec  5 11:58:13 2014
 Contains functions used to calculate the probability of an odor encounter given
 a certain type of turbulent statistics. All functions return the log probability
 of an odor concentration for an array of different possible source positions.
+
+SciPy is only imported inside the functions that need it, so that importing this
+module (and plume, which uses it) only loads NumPy.
 """
 
+from collections import OrderedDict
+
 import numpy as np
-from math_tools.special import logk0
 
-def advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=3):
+import instrumentation
+
+
+def logk0(x, out=None):
+    """Calculate the log of the modified Bessel function of the second kind of order 0.
+
+    This is calculated from the exponentially scaled Bessel function as
+    log(k0e(x)) - x, which stays finite for large x (where k0(x) underflows to 0) and
+    is accurate down to the smallest positive x (where k0e uses its own series).
+
+    Args:
+        x: array of arguments
+        out: optional array to store result in
+    """
+    from scipy.special import k0e
+
+    x = np.asarray(x)
+    if out is not None and np.may_share_memory(x, out):
+        x = x.copy()
+
+    with np.errstate(divide='ignore'):
+        out = np.log(k0e(x, out=out), out=out)
+    out -= x
+
+    return out
+
+
+@instrumentation.instrumented('logprob_odor.advec_diff_mean_hit_rate')
+def advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=3, dtype=None):
     """Calculate the mean hit number at a displacement relative to the source.
+
+    The exponent is a difference of two potentially large numbers, so the calculation
+    is done in the precision of the displacements (double precision if they come from
+    an environment), and only the result is converted to dtype.
     
     Args:
         dx: current x - source x
@@ -24,6 +60,7 @@ def advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=3):
         a: linear particle size (m)
         tau: particle lifetime
         dim: dimension of problem
+        dtype: dtype of result (defaults to that of the calculation)
     """
     
     # calculate absolute distance from source
@@ -47,10 +84,154 @@ def advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=3):
     elif dim == 3:  # 3D
         exponent = (dx*w / (2*d)) - (dr/lam)
         rate = (a*r/dr) * np.exp(exponent)
+
+    if dtype is not None and isinstance(rate, np.ndarray):
+        rate = rate.astype(dtype, copy=False)
+    elif dtype is not None:
+        rate = np.dtype(dtype).type(rate)
     
     return rate
-    
-def binary_advec_diff_tavg(odor, pos_idx, xext, yext, zext, dt, w, r, d, a, tau):
+
+
+def binary_log_probs(mean_hit_num):
+    """Return the log probabilities of a hit (at least one particle) and of a miss
+    (no particles), given the mean number of particles hitting the searcher.
+
+    The hit probability 1 - exp(-mean_hit_num) is calculated with expm1, so that it
+    stays accurate for small mean hit numbers, even in single precision."""
+    Lmiss = -mean_hit_num
+    Lhit = np.log(-np.expm1(-mean_hit_num))
+
+    return Lhit, Lmiss
+
+
+@instrumentation.instrumented('logprob_odor.log_advec_diff_mean_hit_rate')
+def log_advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=3, out=None, tmp=None):
+    """Calculate the log of the mean hit rate at a displacement relative to the source
+    (see advec_diff_mean_hit_rate) without leaving log space.
+
+    Displacements may be open (broadcastable) grids; the full-size result is built in
+    place in out, using at most one other full-size buffer (tmp).
+
+    Args:
+        dx, dy, dz, w, r, d, a, tau, dim: see advec_diff_mean_hit_rate
+        out: optional array to store result in (its dtype sets the precision of the
+            calculation)
+        tmp: optional scratch array with the same shape as out
+    """
+    shape = np.broadcast_shapes(np.shape(dx), np.shape(dy), np.shape(dz))
+    if out is None:
+        out = np.empty(shape, dtype=float)
+
+    # calculate lambda (correlation length)
+    lam = np.sqrt((d*tau) / (1 + ((w**2) * tau) / (4*d)))
+
+    # calculate absolute distance from source
+    np.multiply(dx, dx, out=out)
+    out += np.square(dy)
+    out += np.square(dz)
+    np.sqrt(out, out=out)
+
+    if dim == 2:  # 2D
+        # raise error if particle size is larger than lambda
+        if a > lam:
+            raise ValueError('Particle size a (%.8f) cannot be larger than correlation length (%.8f)!' % (a, lam))
+
+        if tmp is None:
+            tmp = np.empty(shape, dtype=out.dtype)
+
+        np.divide(out, lam, out=tmp)
+        logk0(tmp, out=out)
+        out += np.log(r/np.log(lam/a)) + dx * (w / (2*d))
+
+        # replace nan result from bessel function with np.inf
+        out[np.isnan(out)] = np.inf
+    elif dim == 3:  # 3D
+        if tmp is None:
+            tmp = np.empty(shape, dtype=out.dtype)
+
+        with np.errstate(divide='ignore'):
+            np.log(out, out=tmp)
+        out /= -lam
+        out -= tmp
+        out += np.log(a*r) + dx * (w / (2*d))
+
+    return out
+
+
+@instrumentation.instrumented('logprob_odor.binary_advec_diff_log_probs')
+def binary_advec_diff_log_probs(dx, dy, dz, dt, w, r, d, a, tau, dim=3, lhit=None, lmiss=None):
+    """Calculate the log probabilities of a hit and of a miss (see binary_log_probs)
+    at a displacement relative to the source, given the time-averaged
+    advection-diffusion model.
+
+    This is a fused version of binary_log_probs(dt * advec_diff_mean_hit_rate(...)):
+    the log mean hit number is calculated directly, and the result is built in the
+    two output buffers without any other full-size temporaries. The hit log
+    probability log(1 - exp(-mu)) is calculated as log(-expm1(-mu)), or as log(mu)
+    when mu is so small that they are equal to within 1e-9.
+
+    Args:
+        dx, dy, dz, w, r, d, a, tau, dim: see advec_diff_mean_hit_rate
+        dt: time interval over which odor was averaged (s)
+        lhit: optional array to store hit log probabilities in
+        lmiss: optional array to store miss log probabilities in
+
+    Returns:
+        hit and miss log probabilities
+    """
+    shape = np.broadcast_shapes(np.shape(dx), np.shape(dy), np.shape(dz))
+    if lhit is None:
+        lhit = np.empty(shape, dtype=float)
+    if lmiss is None:
+        lmiss = np.empty(shape, dtype=lhit.dtype)
+
+    # log mean hit number
+    log_advec_diff_mean_hit_rate(dx, dy, dz, w, r, d, a, tau, dim=dim, out=lhit, tmp=lmiss)
+    lhit += np.log(dt)
+
+    not_tiny = lhit >= -20
+
+    # miss log probability is just minus the mean hit number
+    np.exp(lhit, out=lmiss)
+    np.negative(lmiss, out=lmiss)
+
+    # for tiny mean hit numbers, lhit already holds the hit log probability
+    with np.errstate(divide='ignore'):
+        np.expm1(lmiss, out=lhit, where=not_tiny)
+        np.negative(lhit, out=lhit, where=not_tiny)
+        np.log(lhit, out=lhit, where=not_tiny)
+
+    return lhit, lmiss
+
+
+def _fill_binary_advec_diff_log_probs(lhit, lmiss, dx, dy, dz, dt, w, r, d, a, tau, dim=3, slab_size=2**16):
+    """Fill lhit and/or lmiss (either may be None) with the hit and miss log
+    probabilities at open grids of displacements (see binary_advec_diff_log_probs).
+
+    The calculation is done in double precision one x-slab of about slab_size voxels
+    at a time, so only slab-size double precision temporaries are needed whatever the
+    dtype of the outputs."""
+    shape = (lhit if lhit is not None else lmiss).shape
+    slab_size = min(max(1, slab_size // max(1, int(np.prod(shape[1:])))), shape[0])
+
+    buffers = np.empty((2, slab_size) + shape[1:], dtype=float)
+
+    for x0 in range(0, shape[0], slab_size):
+        x1 = min(x0 + slab_size, shape[0])
+
+        # write straight into double precision outputs
+        slabs = [out[x0:x1] if out is not None and out.dtype == buffers.dtype else buffer[:x1 - x0]
+                 for out, buffer in zip((lhit, lmiss), buffers)]
+        binary_advec_diff_log_probs(dx[x0:x1], dy, dz, dt, w, r, d, a, tau, dim=dim, lhit=slabs[0], lmiss=slabs[1])
+
+        for out, slab in zip((lhit, lmiss), slabs):
+            if out is not None and out.dtype != buffers.dtype:
+                out[x0:x1] = slab
+
+
+@instrumentation.instrumented('logprob_odor.binary_advec_diff_tavg')
+def binary_advec_diff_tavg(odor, pos_idx, xext, yext, zext, dt, w, r, d, a, tau, dtype=float):
     """Calculate the probability of measuring an odor value for a 3D array of
     possible source positions. Specifically, calculates probability of binary
     odor signal using time-averaged advection-diffusion equation. Assumes that
@@ -69,6 +250,7 @@ def binary_advec_diff_tavg(odor, pos_idx, xext, yext, zext, dt, w, r, d, a, tau)
         d: diffusion coefficent (m^2/s)
         a: linear particle size (m)
         tau: particle lifetime (s)
+        dtype: dtype of returned array (e.g. np.float32 to halve memory)
         
     Returns:
         3D array of probabilities of odor encounter for different source
@@ -78,24 +260,387 @@ def binary_advec_diff_tavg(odor, pos_idx, xext, yext, zext, dt, w, r, d, a, tau)
     dx = xext - xext[pos_idx[0]]
     dy = yext - yext[pos_idx[1]]
     dz = zext - zext[pos_idx[2]]
-    DX, DY, DZ = np.meshgrid(dx, dy, dz, indexing='ij')
+    DX, DY, DZ = np.meshgrid(dx, dy, dz, indexing='ij', sparse=True)
     
     if len(zext) == 1:
         dim = 2
     else:
         dim = 3
-        
-    mean_hit_num = dt * advec_diff_mean_hit_rate(-DX, -DY, -DZ, w, r, d, a, tau, dim=dim)
-    
-    Lmiss = -mean_hit_num
-    Lhit = np.log(np.maximum(0., 1 - np.exp(-mean_hit_num)))
-    
-    # Calculate probability of odor at pidx for al possible source positions
+
+    # the exponent is a difference of two potentially large numbers, so this is
+    # calculated in double precision (one slab at a time) and only the result is
+    # stored in dtype; only the log probability of the observed odor is built
+    LPodor = np.empty((len(dx), len(dy), len(dz)), dtype=dtype)
     if odor:
-        LPodor = Lhit
+        _fill_binary_advec_diff_log_probs(LPodor, None, -DX, -DY, -DZ, dt, w, r, d, a, tau, dim=dim)
     else:
-        LPodor = Lmiss      
-    
+        _fill_binary_advec_diff_log_probs(None, LPodor, -DX, -DY, -DZ, dt, w, r, d, a, tau, dim=dim)
+
     return LPodor
     
-binary_advec_diff_tavg.domain = np.array([0, 1])
\ No newline at end of file
+binary_advec_diff_tavg.domain = np.array([0, 1])
+
+
+class BinaryAdvecDiffKernel(object):
+    """Log probability kernel for binary odor under the time-averaged
+    advection-diffusion model.
+
+    Since the log probability of an odor value depends only on the displacement
+    between the searcher and the source, it is computed once for every displacement
+    possible on a grid of the given shape and spacing (i.e., on a grid of twice the
+    size). The log probability over all source positions for any searcher position
+    is then just a view into the kernel.
+
+    Args:
+        shape: number of grid points along x, y, and z
+        spacing: distance between grid points along x, y, and z
+        dt, w, r, d, a, tau, dtype: see binary_advec_diff_tavg
+    """
+
+    def __init__(self, shape, spacing, dt, w, r, d, a, tau, dtype=float):
+        self.shape = tuple(shape)
+        self.spacing = tuple(spacing)
+        self.dtype = np.dtype(dtype)
+
+        # source minus searcher position, from -(n-1) to (n-1) grid points along each axis
+        dx, dy, dz = [spc * np.arange(-(n - 1), n) for n, spc in zip(self.shape, self.spacing)]
+        DX, DY, DZ = np.meshgrid(dx, dy, dz, indexing='ij', sparse=True)
+
+        if self.shape[2] == 1:
+            dim = 2
+        else:
+            dim = 3
+
+        # calculated in double precision one slab at a time, but stored in dtype
+        kernel_shape = (len(dx), len(dy), len(dz))
+        self.lhit = np.empty(kernel_shape, dtype=self.dtype)
+        self.lmiss = np.empty(kernel_shape, dtype=self.dtype)
+        _fill_binary_advec_diff_log_probs(self.lhit, self.lmiss, -DX, -DY, -DZ, dt, w, r, d, a, tau, dim=dim)
+
+        # views of these are handed out, so make sure nobody can modify them
+        self.lmiss.flags.writeable = False
+        self.lhit.flags.writeable = False
+
+        # FFTs of the kernels for convolving them with hit/miss counts, by padded shape
+        self._ffts = {}
+
+    @property
+    def nbytes(self):
+        """Memory used by the kernels and their cached FFTs."""
+        return self.lhit.nbytes + self.lmiss.nbytes + sum(f.nbytes for ffts in self._ffts.values() for f in ffts)
+
+    def logprob(self, odor, pos_idx):
+        """Return a read-only view of the log probability of odor for all source
+        positions, given the searcher's position idx."""
+        nx, ny, nz = self.shape
+        xidx, yidx, zidx = pos_idx
+
+        if odor:
+            kernel = self.lhit
+        else:
+            kernel = self.lmiss
+
+        return kernel[nx - 1 - xidx:2 * nx - 1 - xidx,
+                      ny - 1 - yidx:2 * ny - 1 - yidx,
+                      nz - 1 - zidx:2 * nz - 1 - zidx]
+
+    def fft(self, fft_shape):
+        """Return the real FFTs of the finite parts of the hit and miss kernels, and of
+        indicators of where they are -inf, zero-padded to fft_shape.
+
+        These are always calculated in double precision, since the convolution sums
+        over many observations."""
+        import scipy.fft
+
+        if fft_shape not in self._ffts:
+            ffts = []
+            for kernel in (self.lhit, self.lmiss):
+                impossible = np.isneginf(kernel)
+                ffts += [scipy.fft.rfftn(np.where(impossible, 0., kernel).astype(float), fft_shape),
+                         scipy.fft.rfftn(impossible.astype(float), fft_shape)]
+
+            self._ffts[fft_shape] = ffts
+
+        return self._ffts[fft_shape]
+
+    @instrumentation.instrumented_method
+    def convolve(self, hit_counts, miss_counts):
+        """Return the total log probability of a set of observations for all source
+        positions, given the number of hits and misses observed at each position idx.
+
+        This equals summing logprob over all observations, but is done with FFT
+        convolutions, which is much faster for long trajectories."""
+        import scipy.fft
+
+        # the log probability at source position s is the sum over positions p of
+        # hit_counts[p] * lhit[s - p + n - 1] + miss_counts[p] * lmiss[s - p + n - 1],
+        # i.e. the full convolution of the counts with the kernels, cropped. The full
+        # convolution has 3n - 2 elements per axis, but those that wrap around a
+        # circular convolution of length 2n - 1 all land outside the crop
+        fft_shape = tuple(scipy.fft.next_fast_len(2 * n - 1, real=True) for n in self.shape)
+        crop = tuple(slice(n - 1, 2 * n - 1) for n in self.shape)
+
+        fhit, fhit_impossible, fmiss, fmiss_impossible = self.fft(fft_shape)
+        fhit_counts = scipy.fft.rfftn(hit_counts, fft_shape)
+        fmiss_counts = scipy.fft.rfftn(miss_counts, fft_shape)
+
+        logprob = scipy.fft.irfftn(fhit_counts * fhit + fmiss_counts * fmiss, fft_shape)[crop]
+
+        # -inf terms can't go through the FFT, so count them separately
+        n_impossible = scipy.fft.irfftn(fhit_counts * fhit_impossible + fmiss_counts * fmiss_impossible,
+                                        fft_shape)[crop]
+        logprob[n_impossible > 0.5] = -np.inf
+
+        return logprob.astype(self.dtype, copy=False)
+
+
+# kernels cover (2n - 1)**3 displacements, so the cache of recently built ones is
+# bounded by their total size (in bytes, FFTs included) rather than their number
+kernel_cache_max_bytes = 2**30
+_kernel_cache = OrderedDict()
+
+
+def binary_advec_diff_kernel(shape, spacing, dt, w, r, d, a, tau, dtype=float):
+    """Return a BinaryAdvecDiffKernel, reusing one of the most recently built ones
+    if it has the same shape, spacing, parameters and dtype.
+
+    The least recently used kernels are dropped from the cache whenever the kernels
+    in it take more than kernel_cache_max_bytes (except the one being returned)."""
+    key = (tuple(shape), tuple(spacing), dt, w, r, d, a, tau, np.dtype(dtype))
+
+    kernel = _kernel_cache.pop(key, None)
+    if kernel is None:
+        kernel = BinaryAdvecDiffKernel(shape, spacing, dt, w, r, d, a, tau, dtype=dtype)
+    _kernel_cache[key] = kernel
+
+    evict_kernels()
+
+    return kernel
+
+
+def evict_kernels(max_bytes=None):
+    """Drop the least recently used kernels from the cache until it takes at most
+    max_bytes (default kernel_cache_max_bytes), always keeping the most recent one."""
+    if max_bytes is None:
+        max_bytes = kernel_cache_max_bytes
+
+    while len(_kernel_cache) > 1 and sum(kernel.nbytes for kernel in _kernel_cache.values()) > max_bytes:
+        _kernel_cache.popitem(last=False)
+
+
+def grid_spacing(ext):
+    """Return the spacing of an evenly spaced range of positions (0 if it has only one)."""
+    if len(ext) == 1:
+        return 0.
+
+    spacing = float(ext[1] - ext[0])
+    if not np.allclose(np.diff(ext), spacing):
+        raise ValueError('Positions must be evenly spaced to use a displacement kernel!')
+
+    return spacing
+
+
+@instrumentation.instrumented('logprob_odor.binary_advec_diff_tavg_cached')
+def binary_advec_diff_tavg_cached(odor, pos_idx, xext, yext, zext, dt, w, r, d, a, tau, dtype=float):
+    """Same as binary_advec_diff_tavg, but computed by cropping a cached displacement
+    kernel (see BinaryAdvecDiffKernel) instead of evaluating the hit rate over the
+    whole grid each time. xext, yext and zext must be evenly spaced.
+
+    Returns:
+        read-only view of 3D array of log probabilities of odor for different source
+        locations, with dimensions corresponding to xext, yext, and zext."""
+
+    shape = (len(xext), len(yext), len(zext))
+    spacing = (grid_spacing(xext), grid_spacing(yext), grid_spacing(zext))
+
+    kernel = binary_advec_diff_kernel(shape, spacing, dt, w, r, d, a, tau, np.dtype(dtype))
+
+    return kernel.logprob(odor, pos_idx)
+
+binary_advec_diff_tavg_cached.domain = np.array([0, 1])
+
+
+def hit_miss_counts(pos_idxs, odors, shape):
+    """Histogram a sequence of binary odor observations into grids of hit and miss counts.
+
+    Args:
+        pos_idxs: (T, 3) array of position idxs, e.g. from
+            Environment3d.discretize_position_sequence
+        odors: length T array of binary odor values (hit = 1, miss = 0)
+        shape: shape of environment
+
+    Returns:
+        hit counts and miss counts, each an array with the given shape"""
+    pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+    hits = np.asarray(odors).ravel() > 0
+
+    flat_idxs = np.ravel_multi_index(tuple(pos_idxs.T), shape)
+    n_voxels = int(np.prod(shape))
+
+    hit_counts = np.bincount(flat_idxs, weights=hits, minlength=n_voxels).reshape(shape)
+    miss_counts = np.bincount(flat_idxs, weights=~hits, minlength=n_voxels).reshape(shape)
+
+    return hit_counts, miss_counts
+
+
+@instrumentation.instrumented('logprob_odor.binary_advec_diff_tavg_fft')
+def binary_advec_diff_tavg_fft(hit_counts, miss_counts, xext, yext, zext, dt, w, r, d, a, tau, dtype=float):
+    """Calculate the total log probability of many binary odor observations for a 3D
+    array of possible source positions, given the number of hits and misses observed
+    at each position (see hit_miss_counts).
+
+    Gives the same result as summing binary_advec_diff_tavg over all observations,
+    but uses FFT convolutions, so its cost does not depend on the number of
+    observations. xext, yext and zext must be evenly spaced.
+
+    Returns:
+        3D array of log probabilities of all observations for different source
+        locations, with dimensions corresponding to xext, yext, and zext."""
+
+    shape = (len(xext), len(yext), len(zext))
+    spacing = (grid_spacing(xext), grid_spacing(yext), grid_spacing(zext))
+
+    kernel = binary_advec_diff_kernel(shape, spacing, dt, w, r, d, a, tau, np.dtype(dtype))
+
+    logprob = kernel.convolve(hit_counts, miss_counts)
+
+    # the kernel's FFTs count towards the cache's size
+    evict_kernels()
+
+    return logprob
+
+
+class SourcePosterior(object):
+    """Streaming posterior over source position given binary odor observations,
+    using the time-averaged advection-diffusion likelihood.
+
+    The unnormalized log posterior is kept in a single buffer with the shape of the
+    environment and updated in place, so memory use does not grow with the number of
+    observations. Log-likelihoods come from a cached BinaryAdvecDiffKernel.
+
+    Args:
+        env: Environment3d whose bin centers are the possible source positions (must
+            be evenly spaced)
+        dt, w, r, d, a, tau: see binary_advec_diff_tavg
+        log_prior: optional array of (unnormalized) log prior probabilities for each
+            source position; uniform if not given
+        dtype: dtype of log posterior buffer (defaults to that of env)
+    """
+
+    def __init__(self, env, dt, w, r, d, a, tau, log_prior=None, dtype=None):
+        self.env = env
+
+        if dtype is None:
+            dtype = env.dtype
+        self.dtype = np.dtype(dtype)
+
+        spacing = (grid_spacing(env.x), grid_spacing(env.y), grid_spacing(env.z))
+        self.kernel = binary_advec_diff_kernel(env.shape, spacing, dt, w, r, d, a, tau, self.dtype)
+
+        self.log_prior = log_prior
+
+        self.log_post = np.zeros(env.shape, dtype=self.dtype)
+        self._scratch = np.zeros(env.shape, dtype=self.dtype)
+        self._log_normalizer = None
+
+        self.reset()
+
+    def reset(self):
+        """Throw away all observations."""
+        if self.log_prior is None:
+            self.log_post[:] = 0.
+        else:
+            self.log_post[:] = self.log_prior
+
+        self.n_obs = 0
+        self._log_normalizer = None
+
+    def update(self, pos_idx, odor):
+        """Incorporate one binary odor observation made at pos_idx."""
+        np.add(self.log_post, self.kernel.logprob(odor, pos_idx), out=self.log_post)
+
+        self.n_obs += 1
+        self._log_normalizer = None
+
+    def update_many(self, pos_idxs, odors):
+        """Incorporate a sequence of binary odor observations made at pos_idxs.
+
+        Repeated (pos_idx, odor) pairs are only added once, scaled by how often they occur."""
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+        odors = (np.asarray(odors).ravel() > 0).astype(int)
+
+        obs_keys = np.ravel_multi_index((pos_idxs[:, 0], pos_idxs[:, 1], pos_idxs[:, 2], odors),
+                                        self.env.shape + (2,))
+        unique_keys, counts = np.unique(obs_keys, return_counts=True)
+
+        for key, count in zip(unique_keys, counts):
+            xidx, yidx, zidx, odor = np.unravel_index(key, self.env.shape + (2,))
+            lp = self.kernel.logprob(odor, (xidx, yidx, zidx))
+
+            if count == 1:
+                np.add(self.log_post, lp, out=self.log_post)
+            else:
+                np.multiply(lp, count, out=self._scratch)
+                np.add(self.log_post, self._scratch, out=self.log_post)
+
+        self.n_obs += len(odors)
+        self._log_normalizer = None
+
+    def update_counts(self, hit_counts, miss_counts):
+        """Incorporate all observations summarized by grids of hit and miss counts
+        (see hit_miss_counts) at once, using FFT convolutions."""
+        np.add(self.log_post, self.kernel.convolve(hit_counts, miss_counts), out=self.log_post)
+
+        self.n_obs += int(np.sum(hit_counts) + np.sum(miss_counts))
+        self._log_normalizer = None
+
+    @property
+    def log_normalizer(self):
+        """Log of the sum of the exponentiated log posterior buffer.
+
+        This is only recalculated after new observations. The buffer is shifted so that
+        its maximum is zero each time, which keeps the log-sum-exp well-conditioned no
+        matter how many observations have been made."""
+        if self._log_normalizer is None:
+            log_post_max = self.log_post.max()
+
+            if np.isfinite(log_post_max):
+                self.log_post -= log_post_max
+
+            np.exp(self.log_post, out=self._scratch)
+            self._log_normalizer = float(np.log(self._scratch.sum(dtype=float)))
+
+        return self._log_normalizer
+
+    @property
+    def log_posterior(self):
+        """Normalized log posterior over source positions."""
+        return self.log_post - self.log_normalizer
+
+    @property
+    def posterior(self):
+        """Normalized posterior over source positions."""
+        return np.exp(self.log_posterior)
+
+    @property
+    def map_idx(self):
+        """Idx of the maximum a posteriori source position."""
+        return np.unravel_index(np.argmax(self.log_post), self.env.shape)
+
+    @property
+    def map_pos(self):
+        """Maximum a posteriori source position."""
+        return self.env.pos_from_idx(self.map_idx)
+
+    @property
+    def entropy(self):
+        """Entropy (in nats) of the posterior over source positions."""
+        log_normalizer = self.log_normalizer
+
+        # with unnormalized posterior q = exp(log_post) and Z = sum(q),
+        # H = log(Z) - sum(q * log(q)) / Z, skipping impossible positions (q = 0)
+        np.exp(self.log_post, out=self._scratch)
+        possible = self._scratch > 0
+        q_log_q = np.sum(self._scratch[possible] * self.log_post[possible], dtype=float)
+
+        return log_normalizer - q_log_q / np.exp(log_normalizer)
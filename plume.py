@@ -6,13 +6,57 @@ Created on Thu Dec 18 12:07:31 2014
 Classes for various types of plumes.
 """
 
+import itertools
+from functools import lru_cache
+
 import numpy as np
-from scipy.stats import multivariate_normal as mvn
-from logprob_odor import advec_diff_mean_hit_rate
+import instrumentation
+import sparse_field
+import logprob_odor
+
+
+def _outward_offsets(distance, first_width, max_width, growth):
+    """Return offsets of bin edges covering [0, distance], starting with a bin of
+    first_width and growing by growth per bin up to max_width. The last bin is
+    stretched or shrunk (by at most half its width) to end at distance."""
+    offsets = []
+    offset, width = 0., first_width
+
+    while offset + 1.5 * width < distance:
+        offset += width
+        offsets += [offset]
+        width = min(width * growth, max_width)
+
+    if distance > 0:
+        offsets += [distance]
+
+    return np.array(offsets)
+
+
+def refined_bins(lower, upper, center, min_width, max_width=np.inf, growth=1.2):
+    """Return bin edges from lower to upper that are finest around center.
+
+    The bin containing center is min_width wide and centered on it (unless it is
+    cut off by lower or upper), and bin widths grow geometrically by growth per bin
+    away from it, up to max_width.
+    """
+    c0 = max(center - 0.5 * min_width, lower)
+    c1 = min(center + 0.5 * min_width, upper)
+
+    left = c0 - _outward_offsets(c0 - lower, min_width * growth, max_width, growth)[::-1]
+    right = c1 + _outward_offsets(upper - c1, min_width * growth, max_width, growth)
+
+    return np.concatenate([left, [c0, c1], right])
 
 
 class Environment3d(object):
-    """3D environment object."""
+    """3D environment object.
+
+    Bins may be any strictly increasing edges. If they are uniform along every axis,
+    positions are converted to idxs arithmetically, and otherwise by binary search
+    over the bin edges. See Environment3d.refined for an environment whose bins are
+    finest around a source.
+    """
 
     @staticmethod
     def diagonalest_lattice_path(r0, r1):
@@ -47,12 +91,56 @@ class Environment3d(object):
 
         return pos_idxs
 
-    def __init__(self, xbins, ybins, zbins):
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def lattice_connector(displacement):
+        """Return the diagonalest lattice path from the origin to an integer displacement.
+
+        Since connecting paths depend only on the displacement between their endpoints,
+        these are memoized and shifted into place by the caller. The returned array is
+        read-only since it is shared between calls."""
+        displacement = tuple(int(d) for d in displacement)
+        path = Environment3d.diagonalest_lattice_path((0, 0, 0), displacement).astype(int)
+        path.flags.writeable = False
+
+        return path
+
+    @classmethod
+    def refined(cls, xlim, ylim, zlim, src_pos, min_width, max_width=np.inf, growth=1.2, dtype=float):
+        """Make an environment whose bins are finest around a source position (see
+        refined_bins), to resolve steep concentration gradients there with far fewer
+        voxels than a uniform grid.
+
+        Args:
+            xlim, ylim, zlim: (lower, upper) limits along each axis
+            src_pos: source position, which will be at the center of a bin
+            min_width: width of the bins containing the source (a scalar or one per axis)
+            max_width: maximum bin width (a scalar or one per axis)
+            growth: factor by which bin widths grow away from the source
+            dtype: default dtype of fields defined over this environment
+        """
+        min_widths = np.broadcast_to(min_width, (3,))
+        max_widths = np.broadcast_to(max_width, (3,))
+
+        bins = [refined_bins(lim[0], lim[1], center, min_w, max_w, growth)
+                for lim, center, min_w, max_w in zip((xlim, ylim, zlim), src_pos, min_widths, max_widths)]
+
+        return cls(*bins, dtype=dtype)
+
+    def __init__(self, xbins, ybins, zbins, dtype=float):
         # store bins
         self.xbins = xbins
         self.ybins = ybins
         self.zbins = zbins
 
+        for bins in (xbins, ybins, zbins):
+            if np.any(np.diff(bins) <= 0):
+                raise ValueError('Bins must be strictly increasing!')
+
+        # default dtype of fields defined over this environment (positions are
+        # always stored in double precision)
+        self.dtype = np.dtype(dtype)
+
         # calculate bin centers
         self.x = 0.5 * (xbins[:-1] + xbins[1:])
         self.y = 0.5 * (ybins[:-1] + ybins[1:])
@@ -68,11 +156,23 @@ class Environment3d(object):
         self.yidx = np.arange(len(self.y), dtype=int)
         self.zidx = np.arange(len(self.z), dtype=int)
 
-        # store other useful information
+        # store other useful information (dx, dy & dz are the widths of the first
+        # bins, which are the widths of all of them if the bins are uniform)
         self.dx = xbins[1] - xbins[0]
         self.dy = ybins[1] - ybins[0]
         self.dz = zbins[1] - zbins[0]
 
+        self.xwidths = np.diff(xbins)
+        self.ywidths = np.diff(ybins)
+        self.zwidths = np.diff(zbins)
+
+        self.uniform = all(np.allclose(widths, widths[0], rtol=1e-9, atol=0)
+                           for widths in (self.xwidths, self.ywidths, self.zwidths))
+
+        # inner bin edges, for converting positions to idxs if bins aren't uniform
+        self.inner_edges = (np.asarray(xbins[1:-1], dtype=float), np.asarray(ybins[1:-1], dtype=float),
+                            np.asarray(zbins[1:-1], dtype=float))
+
         self.nx = len(self.x)
         self.ny = len(self.y)
         self.nz = len(self.z)
@@ -90,6 +190,11 @@ class Environment3d(object):
         self.yint = self.y[0]
         self.zint = self.z[0]
 
+        # same as above, but stacked for converting many positions at once
+        self.slopes = np.array([self.xslope, self.yslope, self.zslope])
+        self.ints = np.array([self.xint, self.yint, self.zint])
+        self.max_idxs = np.array(self.shape) - 1
+
         # get center idxs
         self.center_xidx = int(np.floor(self.nx/2))
         self.center_yidx = int(np.floor(self.ny/2))
@@ -108,6 +213,9 @@ class Environment3d(object):
     def idx_from_pos(self, pos):
         """Return the index corresponding to the specified postion."""
 
+        if not self.uniform:
+            return tuple(int(idx) for idx in self.idxs_from_positions(pos)[0])
+
         xidx = np.round((pos[0] - self.xint) * self.xslope)
         yidx = np.round((pos[1] - self.yint) * self.yslope)
         zidx = np.round((pos[2] - self.zint) * self.zslope)
@@ -133,6 +241,50 @@ class Environment3d(object):
 
         return xidx, yidx, zidx
 
+    def idxs_from_positions(self, positions):
+        """Return the indices corresponding to an (N, 3) array of positions.
+
+        Vectorized version of idx_from_pos; out-of-bounds positions are clamped
+        to the nearest edge index."""
+
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+
+        if not self.uniform:
+            # find the bin each position is in
+            return np.stack([np.searchsorted(edges, positions[:, dim], side='right')
+                             for dim, edges in enumerate(self.inner_edges)], axis=1)
+
+        idxs = np.round((positions - self.ints) * self.slopes).astype(int)
+        np.clip(idxs, 0, self.max_idxs, out=idxs)
+
+        return idxs
+
+    def interp_corners(self, positions):
+        """Return the idxs and trilinear interpolation weights of the bin centers
+        surrounding each of an (N, 3) array of positions. Positions beyond the outermost
+        bin centers are clamped to them, and axes with a single bin (e.g. z if nz == 1)
+        are not interpolated along.
+
+        Returns:
+            list of ((N, 3) int array of idxs, length N array of weights) tuples, one for
+            each corner of the surrounding cell"""
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+
+        axes = []
+        for dim, centers in enumerate((self.x, self.y, self.z)):
+            p = positions[:, dim]
+
+            if len(centers) == 1:
+                axes += [[(np.zeros(len(p), dtype=int), np.ones(len(p)))]]
+                continue
+
+            lower = np.clip(np.searchsorted(centers, p, side='right') - 1, 0, len(centers) - 2)
+            frac = np.clip((p - centers[lower]) / (centers[lower + 1] - centers[lower]), 0, 1)
+            axes += [[(lower, 1 - frac), (lower + 1, frac)]]
+
+        return [(np.stack([xidxs, yidxs, zidxs], axis=1), xweights * yweights * zweights)
+                for (xidxs, xweights), (yidxs, yweights), (zidxs, zweights) in itertools.product(*axes)]
+
     def idx_out_of_bounds(self, pos_idx):
         """Check whether position idx is out of bounds."""
         if np.any(np.less(pos_idx, 0)):
@@ -142,47 +294,153 @@ class Environment3d(object):
 
         return False
 
+    def idxs_out_of_bounds(self, pos_idxs):
+        """Return a boolean mask of which rows of an (N, 3) index array are
+        out of bounds. Vectorized version of idx_out_of_bounds."""
+
+        pos_idxs = np.asarray(pos_idxs).reshape(-1, 3)
+
+        return np.any((pos_idxs < 0) | (pos_idxs >= self.shape), axis=1)
+
+    def connect_idxs(self, idxs):
+        """Return the lattice path that visits each row of an (N, 3) idx array in order,
+        moving one lattice step at a time and excluding the first idx.
+
+        Adjacent duplicates contribute no steps, and gaps are filled in with the
+        diagonalest lattice path between them."""
+
+        idxs = np.asarray(idxs, dtype=int).reshape(-1, 3)
+
+        # the number of steps between adjacent idxs is their L1 distance
+        disps = np.diff(idxs, axis=0)
+        l1_dists = np.abs(disps).sum(axis=1)
+
+        n_steps = l1_dists.sum()
+        if n_steps == 0:
+            return np.zeros((0, 3), dtype=int)
+
+        # tabulate one connector per distinct displacement (displacements are encoded
+        # as flat integer keys since row-wise np.unique is slow)
+        disp_mins = disps.min(axis=0)
+        disp_spans = tuple(disps.max(axis=0) - disp_mins + 1)
+        disp_keys = np.ravel_multi_index(tuple((disps - disp_mins).T), disp_spans)
+
+        unique_keys, disp_inverse = np.unique(disp_keys, return_inverse=True)
+        unique_disps = np.array(np.unravel_index(unique_keys, disp_spans)).T + disp_mins
+
+        connectors = [self.lattice_connector(tuple(disp)) for disp in unique_disps]
+        connector_lens = np.array([len(connector) for connector in connectors])
+        connector_starts = connector_lens.cumsum() - connector_lens
+        table = np.concatenate(connectors, axis=0)
+
+        # figure out which pair of idxs each output step belongs to and how far along
+        # its connector it is
+        pair_of_step = np.repeat(np.arange(len(disps)), l1_dists)
+        pair_starts = l1_dists.cumsum() - l1_dists
+        step_in_pair = np.arange(n_steps) - pair_starts[pair_of_step]
+
+        table_rows = connector_starts[disp_inverse[pair_of_step]] + step_in_pair
+
+        return table[table_rows] + idxs[pair_of_step]
+
+    @instrumentation.instrumented_method
     def discretize_position_sequence(self, positions):
+        """Convert a sequence of positions into a sequence of lattice idxs such that
+        each idx is exactly one step away from the previous one.
+
+        Returns:
+            (M, 3) int array of position idxs"""
 
         # convert all positions to idxs
-        idxs = np.array([self.idx_from_pos(pos) for pos in positions])
+        idxs = self.idxs_from_positions(positions)
 
-        # calculate L1 distance between every pair of adjacent idxs
-        l1_dists = np.abs(np.diff(idxs, axis=0)).sum(axis=1)
+        return np.concatenate([idxs[:1], self.connect_idxs(idxs)], axis=0)
 
-        # split idxs into chunks such of adjacent idxs
-        split_idxs = (l1_dists > 1).nonzero()[0]
-        chunks = np.split(idxs, split_idxs + 1)
+    def discretize_position_chunks(self, chunks):
+        """Discretize a (possibly unbounded) stream of position chunks.
 
-        # calculate connecting path for each pair of adjacent chunks
-        connectors = []
-        for cctr, chunk in enumerate(chunks[:-1]):
-            next_chunk = chunks[cctr + 1]
-            connectors += [self.diagonalest_lattice_path(chunk[-1], next_chunk[0])]
+        Yields one (M, 3) int array of position idxs per chunk; concatenating them gives
+        the same result as discretize_position_sequence on the full trajectory."""
 
-        # interleave chunks with connectors
-        temp_idxs = [None] * (len(chunks) + len(connectors))
-        temp_idxs[::2] = chunks
-        temp_idxs[1::2] = connectors
-        temp_idxs = np.concatenate(temp_idxs)
+        discretizer = PositionSequenceDiscretizer(self)
 
-        # remove adjacent duplicates
-        final_idxs = [temp_idxs[0]]
-        for temp_idx in temp_idxs[1:]:
-            if not np.all(temp_idx == final_idxs[-1]):
-                final_idxs += [temp_idx]
+        for positions in chunks:
+            yield discretizer.discretize(positions)
 
-        return final_idxs
+
+class PositionSequenceDiscretizer(object):
+    """Stateful discretizer for trajectories that arrive in chunks.
+
+    The last lattice idx of each chunk is kept so that the connecting path and
+    duplicate removal across chunk boundaries match the batch result."""
+
+    def __init__(self, env):
+        self.env = env
+        self.last_idx = None
+
+    def reset(self):
+        """Forget the last idx, so that the next chunk starts a new trajectory."""
+        self.last_idx = None
+
+    def discretize(self, positions):
+        """Return the position idxs visited since the previous chunk."""
+
+        idxs = self.env.idxs_from_positions(positions)
+
+        if len(idxs) == 0:
+            return np.zeros((0, 3), dtype=int)
+
+        if self.last_idx is None:
+            pos_idxs = np.concatenate([idxs[:1], self.env.connect_idxs(idxs)], axis=0)
+        else:
+            pos_idxs = self.env.connect_idxs(np.concatenate([self.last_idx[None, :], idxs], axis=0))
+
+        self.last_idx = idxs[-1].copy()
+
+        return pos_idxs
+
+
+def spawn_seeds(seed, n_streams):
+    """Spawn statistically independent child seeds from a single seed, e.g. one
+    for each of several worker processes.
+
+    Args:
+        seed: int, sequence of ints or np.random.SeedSequence
+        n_streams: number of child seeds to make
+
+    Returns:
+        list of np.random.SeedSequence objects, each of which can be passed as the
+        seed of a plume"""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    return seed.spawn(n_streams)
 
 
 class Plume(object):
+
+    # hot paths that are counted and timed when instrumentation is enabled
+    instrumented_methods = ('initialize', 'sample', 'sample_many', 'update')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrumentation.instrument_methods(cls, cls.instrumented_methods)
     
-    def __init__(self, env, dt=.01, orm=None):
+    def __init__(self, env, dt=.01, orm=None, seed=None, dtype=None):
         
         # set bins and timestep
         self.env = env
         self.dt = dt
 
+        # set dtype of plume fields
+        if dtype is None:
+            dtype = env.dtype
+        self.dtype = np.dtype(dtype)
+
+        # set random number generator
+        self.rng = None
+        self.set_seed(seed)
+
         self.ts = 0
         self.t = 0.
 
@@ -207,11 +465,25 @@ class Plume(object):
 
         self.conc = None
 
+        # how initialize stores the field (see set_storage)
+        self.storage = 'dense'
+        self.storage_tol = 0.
+        self.block_shape = (16, 16, 16)
+        self.cache_size = 0
+
         self._orm = None
 
         if orm:
             self.orm = orm
 
+    def set_seed(self, seed=None):
+        """Set the random number generator used for sampling.
+
+        Args:
+            seed: anything np.random.default_rng accepts (None, int, np.random.SeedSequence,
+                np.random.Generator); None draws fresh entropy from the OS"""
+        self.rng = np.random.default_rng(seed)
+
     def reset(self):
         """Reset plume params."""
         # reset time and timestep
@@ -235,6 +507,68 @@ class Plume(object):
         self.srcxidx, self.srcyidx, self.srczidx = self.src_pos_idx
         self.srcx, self.srcy, self.srcz = self.src_pos
                 
+    def set_storage(self, storage='dense', tol=0., block_shape=(16, 16, 16), cache_size=0):
+        """Choose how initialize stores the field.
+
+        Sparse and analytic fields are indexed just like dense ones (conc[...]), so
+        sampling and concxy/concxz/concyz work the same with any of them.
+
+        Args:
+            storage: 'dense' for a full array, 'box' for a dense bounding box of the voxels
+                that differ from the background by more than tol (see
+                sparse_field.BoxField), 'block' for a block-sparse tiling of them (see
+                sparse_field.BlockSparseField), or 'analytic' to store nothing and
+                evaluate the closed-form field (see analytic_conc) only where it's sampled
+                (see sparse_field.AnalyticField)
+            tol: voxels that differ from the background by at most this much may be
+                replaced by it; fields that decay smoothly (e.g. BasicPlume) need tol > 0
+                to be stored sparsely
+            block_shape: shape of the blocks of a block-sparse field (the first element
+                is also the thickness of the slabs a box field is built from)
+            cache_size: number of recently evaluated voxels an analytic field caches (0
+                for no cache)
+        """
+        if storage not in ('dense', 'box', 'block', 'analytic'):
+            raise ValueError('Storage must be "dense", "box", "block" or "analytic", not "{}"!'.format(storage))
+
+        if storage == 'analytic' and type(self).analytic_conc is Plume.analytic_conc:
+            raise ValueError('{} has no closed-form field to evaluate!'.format(type(self).__name__))
+
+        self.storage = storage
+        self.storage_tol = tol
+        self.block_shape = tuple(block_shape)
+        self.cache_size = cache_size
+
+    def field_background(self):
+        """Return the value of the field far from the source."""
+        return 0.
+
+    def analytic_conc(self, x, y, z):
+        """Return the field at broadcastable arrays of x, y and z coordinates, for plumes
+        whose field has a closed form (needed for 'analytic' storage)."""
+        raise NotImplementedError
+
+    def build_field(self, conc_slab):
+        """Build a field in the storage chosen with set_storage from conc_slab(x0, x1),
+        which returns the field over x idxs x0:x1. The field is built one slab at a
+        time, so no full-size temporaries are ever needed. An analytic field doesn't use
+        conc_slab, since it is only evaluated when it's indexed."""
+        if self.storage == 'analytic':
+            return sparse_field.AnalyticField(self.env.x, self.env.y, self.env.z, self.analytic_conc,
+                                              self.field_background(), self.cache_size, self.dtype)
+        elif self.storage == 'box':
+            return sparse_field.BoxField.from_slabs(self.env.shape, conc_slab, self.field_background(),
+                                                    self.storage_tol, self.block_shape[0], self.dtype)
+        elif self.storage == 'block':
+            return sparse_field.BlockSparseField.from_slabs(self.env.shape, conc_slab, self.field_background(),
+                                                            self.storage_tol, self.block_shape, self.dtype)
+
+        conc = np.empty(self.env.shape, dtype=self.dtype)
+        for xidx in range(self.env.nx):
+            conc[xidx:xidx + 1] = conc_slab(xidx, xidx + 1)
+
+        return conc
+
     def update_time(self):
         """Update time."""
         self.ts += 1
@@ -244,6 +578,53 @@ class Plume(object):
         """Update everything."""
         self.update_time()
 
+    def load_field(self, conc):
+        """Set the plume's field from a precomputed array (e.g. loaded from a
+        FieldCache) instead of calculating it with initialize."""
+        self.conc = conc
+
+    def conc_at_idxs(self, pos_idxs):
+        """Return the concentration at each row of an (N, 3) array of position idxs."""
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+
+        return self.conc[pos_idxs[:, 0], pos_idxs[:, 1], pos_idxs[:, 2]]
+
+    def sample_many(self, pos_idxs, dt=None):
+        """Sample odor at each row of an (N, 3) array of position idxs.
+
+        Subclasses override this with vectorized versions; by default it just calls
+        sample once per position idx, in which case dt is ignored."""
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+
+        return np.array([self.sample(pos_idx) for pos_idx in pos_idxs])
+
+    def conc_at(self, positions):
+        """Return the concentration at each row of an (N, 3) array of continuous
+        positions, trilinearly interpolated between voxel centers (see
+        Environment3d.interp_corners), or exactly if the field is analytic (in which case
+        positions may also lie outside the environment)."""
+        if isinstance(self.conc, sparse_field.AnalyticField):
+            return self.conc.at(positions)
+
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        conc = np.zeros((len(positions),), dtype=float)
+
+        for pos_idxs, weights in self.env.interp_corners(positions):
+            values = self.conc[pos_idxs[:, 0], pos_idxs[:, 1], pos_idxs[:, 2]]
+            # corners with no weight don't contribute, even if they're infinite
+            conc += np.where(weights > 0, weights * values, 0.)
+
+        return conc
+
+    def odors_from_conc(self, conc, dt=None):
+        """Sample odor given an array of concentrations."""
+        raise NotImplementedError
+
+    def sample_at(self, positions, dt=None):
+        """Sample odor at each row of an (N, 3) array of continuous positions, using the
+        concentration interpolated by conc_at."""
+        return self.odors_from_conc(self.conc_at(positions), dt)
+
     @property
     def concxy(self):
         return self.conc[:, :, self.env.center_zidx]
@@ -278,26 +659,135 @@ class Plume(object):
         self.set_params(**param_dict)
 
 
+instrumentation.instrument_methods(Plume, Plume.instrumented_methods)
+
+
 class EmptyPlume(Plume):
     
     name = 'empty'
     
     def initialize(self):
         
-        # create meshgrid arrays for setting conc
-        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
-        
         # create empty conc plume
-        self.conc = np.zeros(x.shape, dtype=float)
+        self.conc = self.build_field(lambda x0, x1: np.zeros((x1 - x0, self.env.ny, self.env.nz)))
         
         # store odor domain
         self.odor_domain = [0, 1]
+
+    def load_field(self, conc):
+        self.conc = conc
+        self.odor_domain = [0, 1]
     
     def sample(self, pos_idx):
         return 0
 
+    def sample_many(self, pos_idxs, dt=None):
+        return np.zeros((len(np.asarray(pos_idxs).reshape(-1, 3)),), dtype=int)
 
-class CollimatedPlume(Plume):
+    def odors_from_conc(self, conc, dt=None):
+        return np.zeros(np.shape(conc), dtype=int)
+
+
+class ThresholdPlume(Plume):
+    """Plume whose odor is 1 where the concentration is above threshold and 0 elsewhere
+    (and 0 everywhere if threshold is negative).
+
+    Since odor only depends on the static field, which voxels are above threshold is
+    precomputed when the field is initialized (and again whenever threshold changes)
+    and stored as a packed bit array (detection_map, 1 bit per voxel in C order), which
+    all sampling goes through. Once it's built, drop_field can free the field itself.
+    Analytic fields get no detection map (it would take evaluating the whole grid), so
+    they are compared with threshold wherever they're sampled instead.
+    """
+
+    _threshold = None
+    detection_map = None
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, threshold):
+        if self.conc is None and self.detection_map is not None:
+            raise ValueError('Threshold cannot be changed after the field has been dropped!')
+
+        self._threshold = threshold
+        if self.conc is not None:
+            self.build_detection_map()
+
+    def build_detection_map(self):
+        """Precompute which voxels are above threshold, packed 8 voxels per byte."""
+        if isinstance(self.conc, sparse_field.AnalyticField):
+            self.detection_map = None
+            return
+
+        nx, ny, nz = self.env.shape
+        self.detection_map = np.zeros((-(-nx * ny * nz // 8),), dtype=np.uint8)
+
+        if self.threshold is None or self.threshold < 0:
+            return
+
+        # pack in x-slabs whose voxel counts are multiples of 8, so that every slab but
+        # the last fills a whole number of bytes
+        slab_size = 8 // np.gcd(ny * nz, 8)
+        slab_size *= max(1, 2**20 // (slab_size * ny * nz))
+
+        for x0 in range(0, nx, slab_size):
+            packed = np.packbits(np.asarray(self.conc[x0:x0 + slab_size] > self.threshold).ravel())
+            start = x0 * ny * nz // 8
+            self.detection_map[start:start + len(packed)] = packed
+
+    def drop_field(self):
+        """Free the concentration field, keeping only the detection map (threshold can
+        no longer be changed afterwards)."""
+        if self.detection_map is None:
+            raise ValueError('There is no detection map to sample from without the field!')
+
+        self.conc = None
+
+    def load_field(self, conc):
+        self.conc = conc
+        self.build_detection_map()
+
+    def detected(self, flat_idxs):
+        """Look up whether each of an array of flat (C order) voxel idxs is above threshold."""
+        return (self.detection_map[flat_idxs >> 3] >> (7 - (flat_idxs & 7))) & 1
+
+    def flat_idxs(self, pos_idxs):
+        """Return the flat (C order) voxel idxs of an (N, 3) array of position idxs,
+        which are interpreted like indices into conc: negative idxs count from the
+        end, and out-of-range ones raise IndexError."""
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+
+        for idxs, n in zip(pos_idxs.T, self.env.shape):
+            if np.any((idxs < -n) | (idxs >= n)):
+                raise IndexError('index out of bounds for axis with size {}'.format(n))
+
+        return np.ravel_multi_index(pos_idxs.T, self.env.shape, mode='wrap')
+
+    def sample(self, pos_idx):
+        if self.detection_map is None:
+            return int(self.odors_from_conc(self.conc[tuple(pos_idx)]))
+
+        return int(self.detected(self.flat_idxs(pos_idx))[0])
+
+    def sample_many(self, pos_idxs, dt=None):
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+
+        if self.detection_map is None:
+            return self.odors_from_conc(self.conc_at_idxs(pos_idxs))
+
+        return self.detected(self.flat_idxs(pos_idxs)).astype(int)
+
+    def odors_from_conc(self, conc, dt=None):
+        if self.threshold < 0:
+            return np.zeros(np.shape(conc), dtype=int)
+
+        return (np.asarray(conc) > self.threshold).astype(int)
+
+
+class CollimatedPlume(ThresholdPlume):
 
     name = 'collimated'
 
@@ -334,22 +824,18 @@ class CollimatedPlume(Plume):
             self.zstd = zstd
 
     def initialize(self):
-        # create meshgrid of all locations
-        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
-
-        cov = np.array([[self.ystd**2, 0], [0, self.zstd**2]])
+        # create open meshgrid of all locations (conc doesn't depend on x, so the
+        # exponent only needs to be calculated over the y-z plane)
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij', sparse=True)
 
         exponent = (-0.5 * ((y - self.ymean)**2) / (self.ystd**2)) + (-0.5 * ((z - self.zmean)**2) / (self.zstd**2))
-        self.conc = self.max_conc * np.exp(exponent)
+        conc_yz = self.max_conc * np.exp(exponent)
 
-    def sample(self, pos_idx):
-        if self.conc[tuple(pos_idx)] > self.threshold >= 0:
-            return 1
-        else:
-            return 0
+        self.conc = self.build_field(lambda x0, x1: np.broadcast_to(conc_yz, (x1 - x0,) + conc_yz.shape[1:]))
+        self.build_detection_map()
 
 
-class SpreadingGaussianPlume(Plume):
+class SpreadingGaussianPlume(ThresholdPlume):
     """
     Plume whose cross-section is always Gaussian & whose magnitude decreases hyperbolically (as 1/x) with distance from the source. This is based on "biology and the mechanics of the wave-swept environment" by Mark Denny (pp. 144-147).
 
@@ -375,30 +861,48 @@ class SpreadingGaussianPlume(Plume):
 
         for k, v in kwargs.items():
             self.params[k] = v
-            self.__dict__[k] = v
+            setattr(self, k, v)
 
     def initialize(self):
-        # create meshgrid of all locations
-        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
+        # create open meshgrid of all locations
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij', sparse=True)
+
+        x2 = (x - self.x_source)**2
 
         y_term = ((y - self.y_source)**2) * (self.u**2)
-        y_term /= (2 * (self.alpha_y**2) * (self.u_star**2) * ((x - self.x_source)**2))
+        y_term /= (2 * (self.alpha_y**2) * (self.u_star**2))
 
         z_term = ((z - self.z_source)**2) * (self.u**2)
-        z_term /= (2 * (self.alpha_z**2) * (self.u_star**2) * ((x - self.x_source)**2))
+        z_term /= (2 * (self.alpha_z**2) * (self.u_star**2))
 
-        c = (self.Q * self.u)
-        c /= (2 * np.pi * self.alpha_y * self.alpha_z * (self.u_star**2) * (x - self.x_source)**2)
-        c *= np.exp(-(y_term + z_term))
-        c += self.bkgd
+        scale = (self.Q * self.u)
+        scale /= (2 * np.pi * self.alpha_y * self.alpha_z * (self.u_star**2) * x2)
 
-        self.conc = c
+        def conc_slab(x0, x1):
+            # build each slab in place so that no other temporaries are needed
+            c = np.empty((x1 - x0, self.env.ny, self.env.nz), dtype=self.dtype)
+            np.add(y_term, z_term, out=c)
+            np.divide(c, x2[x0:x1], out=c)
+            np.negative(c, out=c)
+            np.exp(c, out=c)
+            np.multiply(c, scale[x0:x1], out=c)
+            c += self.bkgd
+            return c
 
-    def sample(self, pos_idx):
-        if self.conc[tuple(pos_idx)] > self.threshold >= 0:
-            return 1
-        else:
-            return 0
+        self.conc = self.build_field(conc_slab)
+        self.build_detection_map()
+
+    def field_background(self):
+        return self.bkgd
+
+    def analytic_conc(self, x, y, z):
+        x2 = (x - self.x_source)**2
+        yz_term = ((y - self.y_source)**2) * (self.u**2) / (2 * (self.alpha_y**2) * (self.u_star**2))
+        yz_term = yz_term + ((z - self.z_source)**2) * (self.u**2) / (2 * (self.alpha_z**2) * (self.u_star**2))
+
+        scale = (self.Q * self.u) / (2 * np.pi * self.alpha_y * self.alpha_z * (self.u_star**2) * x2)
+
+        return scale * np.exp(-yz_term / x2) + self.bkgd
 
 
 class PoissonPlume(Plume):
@@ -412,9 +916,35 @@ class PoissonPlume(Plume):
         conc = self.conc[tuple(pos_idx)]
         
         # sample odor from concentration, capping it at max hit number
-        odor = min(np.random.poisson(lam=conc*self.dt), self.max_hit_number)
+        odor = min(self.rng.poisson(lam=conc*self.dt), self.max_hit_number)
         
         return odor
+
+    def poisson_hits(self, mean_hit_nums):
+        """Draw a Poisson hit number for each element of an array of mean hit numbers,
+        capping them at max hit number. Infinite means yield infinite hit numbers."""
+        mean_hit_nums = np.asarray(mean_hit_nums, dtype=float)
+        inf_mask = np.isinf(mean_hit_nums)
+
+        hit_nums = self.rng.poisson(lam=np.where(inf_mask, 0, mean_hit_nums)).astype(float)
+        hit_nums[inf_mask] = np.inf
+        np.minimum(hit_nums, self.max_hit_number, out=hit_nums)
+
+        if np.isinf(self.max_hit_number):
+            return hit_nums
+        return hit_nums.astype(int)
+
+    def sample_many(self, pos_idxs, dt=None):
+        if not dt:
+            dt = self.dt
+
+        return self.poisson_hits(self.conc_at_idxs(pos_idxs) * dt)
+
+    def odors_from_conc(self, conc, dt=None):
+        if not dt:
+            dt = self.dt
+
+        return self.poisson_hits(np.asarray(conc) * dt)
         
 
 class BasicPlume(PoissonPlume):
@@ -457,34 +987,50 @@ class BasicPlume(PoissonPlume):
             self.tau = tau
 
     def initialize(self):
-        # create meshgrid of all locations
-        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
-        # calculate displacement from source
-        dx = x - self.src_pos[0]
-        dy = y - self.src_pos[1]
-        dz = z - self.src_pos[2]
-
-        # calculate mean hit number at all locations
-        self.mean_hit_rate = advec_diff_mean_hit_rate(dx, dy, dz,
-                                                      self.w, self.r, self.d,
-                                                      self.a, self.tau, self.dim)
+        # create open meshgrid of all locations
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij', sparse=True)
+
+        # calculate mean hit number at all locations, one x-slab at a time so that
+        # temporaries are only the size of a slab
+        def conc_slab(x0, x1):
+            return self.analytic_conc(x[x0:x1], y, z)
+
+        self.mean_hit_rate = self.build_field(conc_slab)
         self.conc = self.mean_hit_rate
 
         # store odor domain
         self.odor_domain = range(self.max_hit_number+1)
 
+    def load_field(self, conc):
+        self.mean_hit_rate = conc
+        self.conc = self.mean_hit_rate
+        self.odor_domain = range(self.max_hit_number+1)
+
+    def analytic_conc(self, x, y, z):
+        return logprob_odor.advec_diff_mean_hit_rate(x - self.src_pos[0], y - self.src_pos[1], z - self.src_pos[2],
+                                                     self.w, self.r, self.d, self.a, self.tau, self.dim)
+
     def sample(self, pos_idx, dt=None):
         if not dt:
             dt = self.dt
         # randomly sample from plume
         mean_hit_num = self.mean_hit_rate[tuple(pos_idx)] * dt
         if not np.isinf(mean_hit_num):
-            hit_num = np.random.poisson(lam=mean_hit_num)
+            hit_num = self.rng.poisson(lam=mean_hit_num)
         else:
             hit_num = np.inf
 
         return min(hit_num, self.max_hit_number)
 
+    def sample_many(self, pos_idxs, dt=None):
+        if not dt:
+            dt = self.dt
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+
+        mean_hit_nums = self.mean_hit_rate[pos_idxs[:, 0], pos_idxs[:, 1], pos_idxs[:, 2]] * dt
+
+        return self.poisson_hits(mean_hit_nums)
+
 
 class CollimatedPoissonPlume(PoissonPlume):
     """Stationary collimated plume. Specified by width (meters) and
@@ -494,23 +1040,264 @@ class CollimatedPoissonPlume(PoissonPlume):
     
     def set_aux_params(self, width, peak, max_hit_number):
         # store auxiliary parameters
+        self.params['width'] = width
+        self.params['peak'] = peak
+        self.params['max_hit_number'] = max_hit_number
         self.width = width
         self.peak = peak
         self.max_hit_number = int(max_hit_number)
     
     def initialize(self):
 
-        # create meshgrid arrays for setting conc
-        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
+        # create open meshgrid arrays for setting conc
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij', sparse=True)
         
-        # calculate conc concentration
+        # calculate conc concentration (which only varies over the y-z plane)
         dr2 = (y - self.src_pos[1])**2 + (z - self.src_pos[2])**2
-        
-        self.conc = self.peak * np.exp(-dr2 / (2*self.width))
-        
+        conc_yz = self.peak * np.exp(-dr2 / (2*self.width))
+
         # put mask over space upwind of src
-        mask = (x < self.src_pos[0])
-        self.conc[mask] = 0.
+        mask = (self.env.x < self.src_pos[0])
+
+        def conc_slab(x0, x1):
+            c = np.empty((x1 - x0, self.env.ny, self.env.nz), dtype=self.dtype)
+            c[:] = conc_yz
+            c[mask[x0:x1]] = 0.
+            return c
+
+        self.conc = self.build_field(conc_slab)
         
         # store odor domain
-        self.odor_domain = range(self.max_hit_number+1)
\ No newline at end of file
+        self.odor_domain = range(self.max_hit_number+1)
+
+    def load_field(self, conc):
+        self.conc = conc
+        self.odor_domain = range(self.max_hit_number+1)
+
+
+class PuffPlume(PoissonPlume):
+    """Time-varying plume made of discrete Gaussian puffs released from the source.
+
+    Each update, new puffs are released at the source (the number released is Poisson
+    distributed), existing puffs are advected downwind, their centers wander randomly,
+    and they spread diffusively. Puffs that leave the environment are removed. The
+    concentration at a point is the sum of the concentrations of all puffs, and odor
+    samples are Poisson draws with mean equal to concentration times timestep.
+
+    All puffs are stored in fixed-capacity arrays and advanced with vectorized
+    operations; if there are ever more than max_puffs, the oldest ones are dropped.
+    Concentration is evaluated directly at the sampled positions, and only rasterized
+    onto the environment grid (conc) when asked for.
+
+    Args:
+        w: wind speed (wind blows from negative to positive x-direction) (m/s)
+        release_rate: mean number of puffs released per second (1/s)
+        q: amount of odor per puff (conc*m^3)
+        d: diffusivity governing how quickly puffs spread (m^2/s)
+        sigma_0: initial puff size (m)
+        wander: diffusivity of puff centers (m^2/s)
+        max_puffs: maximum number of puffs
+
+    Default params: w: 0.4
+                    release_rate: 100
+                    q: 1
+                    d: 0.0001
+                    sigma_0: .005
+                    wander: 0.0005
+                    max_puffs: 100000
+    """
+
+    name = 'puff'
+
+    # puffs are evaluated & rasterized in chunks of this many to bound memory use
+    chunk_size = 1024
+
+    # Gaussian factors with exponents below this (i.e. smaller than double precision
+    # resolution relative to the puff's peak) are set to zero, which avoids slow
+    # arithmetic on denormal numbers and lets far-away puffs be skipped
+    min_exponent = -40.
+
+    def set_params(self, w=None, release_rate=None, q=None, d=None, sigma_0=None, wander=None, max_puffs=None):
+        if w is not None:
+            self.params['w'] = w
+            self.w = w
+        if release_rate is not None:
+            self.params['release_rate'] = release_rate
+            self.release_rate = release_rate
+        if q is not None:
+            self.params['q'] = q
+            self.q = q
+        if d is not None:
+            self.params['d'] = d
+            self.d = d
+        if sigma_0 is not None:
+            self.params['sigma_0'] = sigma_0
+            self.sigma_0 = sigma_0
+        if wander is not None:
+            self.params['wander'] = wander
+            self.wander = wander
+        if max_puffs is not None:
+            self.params['max_puffs'] = max_puffs
+            self.max_puffs = int(max_puffs)
+
+    def initialize(self):
+        # allocate puff arrays; only the first n_puffs rows are in use, ordered from oldest to newest
+        self.puff_pos = np.zeros((self.max_puffs, 3), dtype=float)
+        self.puff_var = np.zeros((self.max_puffs,), dtype=float)
+        self.n_puffs = 0
+
+        # the grid is only allocated if conc is rasterized
+        self.conc = None
+        self._conc_ts = None
+
+        # store odor domain
+        self.odor_domain = range(self.max_hit_number+1)
+
+    def reset(self):
+        super(PuffPlume, self).reset()
+        self.n_puffs = 0
+        self._conc_ts = None
+
+    @property
+    def puffs(self):
+        """Positions and variances of all current puffs."""
+        return self.puff_pos[:self.n_puffs], self.puff_var[:self.n_puffs]
+
+    def update(self):
+        """Advance all puffs by one timestep and release new ones."""
+        self.update_time()
+
+        n = self.n_puffs
+        pos = self.puff_pos[:n]
+
+        # advect, wander & spread existing puffs
+        pos[:, 0] += self.w * self.dt
+        pos += self.rng.normal(0, np.sqrt(2 * self.wander * self.dt), (n, 3))
+        if self.dim == 2:
+            pos[:, 2] = self.srcz
+        self.puff_var[:n] += 2 * self.d * self.dt
+
+        # remove puffs that are well outside the environment
+        margin = 3 * np.sqrt(self.puff_var[:n])
+        keep = (pos[:, 0] - margin < self.env.xbins[-1]) & (pos[:, 0] + margin > self.env.xbins[0]) & \
+               (pos[:, 1] - margin < self.env.ybins[-1]) & (pos[:, 1] + margin > self.env.ybins[0])
+        if self.dim == 3:
+            keep &= (pos[:, 2] - margin < self.env.zbins[-1]) & (pos[:, 2] + margin > self.env.zbins[0])
+
+        if not np.all(keep):
+            n = int(keep.sum())
+            self.puff_pos[:n] = pos[keep]
+            self.puff_var[:n] = self.puff_var[:self.n_puffs][keep]
+            self.n_puffs = n
+
+        # release new puffs, dropping the oldest ones if there isn't room
+        n_new = min(self.rng.poisson(self.release_rate * self.dt), self.max_puffs)
+        n_drop = max(self.n_puffs + n_new - self.max_puffs, 0)
+        if n_drop:
+            n = self.n_puffs - n_drop
+            self.puff_pos[:n] = self.puff_pos[n_drop:self.n_puffs].copy()
+            self.puff_var[:n] = self.puff_var[n_drop:self.n_puffs].copy()
+            self.n_puffs = n
+
+        self.puff_pos[self.n_puffs:self.n_puffs + n_new] = self.src_pos
+        self.puff_var[self.n_puffs:self.n_puffs + n_new] = self.sigma_0**2
+        self.n_puffs += n_new
+
+    def _gaussian(self, dr2, var):
+        """Return the unnormalized Gaussian exp(-dr2 / (2 * var)), flushed to zero far from the mean."""
+        exponent = -dr2 / (2 * var)
+        g = np.exp(exponent)
+        g[exponent < self.min_exponent] = 0.
+
+        return g
+
+    def conc_at(self, positions):
+        """Return the concentration at each row of an (N, 3) array of positions."""
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        conc = np.zeros((len(positions),), dtype=float)
+
+        if self.n_puffs == 0 or len(positions) == 0:
+            return conc
+
+        # sort puffs and positions along x, so that each chunk of puffs only needs to be
+        # compared with the positions within reach of it
+        puff_order = np.argsort(self.puff_pos[:self.n_puffs, 0])
+        position_order = np.argsort(positions[:, 0])
+        sorted_x = positions[position_order, 0]
+
+        for start in range(0, self.n_puffs, self.chunk_size):
+            chunk = puff_order[start:start + self.chunk_size]
+            pos = self.puff_pos[chunk]
+            var = self.puff_var[chunk]
+
+            # beyond this distance a puff's contribution would be flushed to zero anyway
+            reach = np.sqrt(-2 * self.min_exponent * var.max())
+            lower, upper = np.searchsorted(sorted_x, [pos[0, 0] - reach, pos[-1, 0] + reach])
+            if lower == upper:
+                continue
+            nearby = position_order[lower:upper]
+            nearby_positions = positions[nearby]
+
+            # squared distances between every nearby position and puff
+            dr2 = (nearby_positions[:, None, 0] - pos[None, :, 0])**2 + \
+                  (nearby_positions[:, None, 1] - pos[None, :, 1])**2
+            if self.dim == 3:
+                dr2 += (nearby_positions[:, None, 2] - pos[None, :, 2])**2
+
+            norm = self.q / (2 * np.pi * var)**(self.dim / 2.)
+            conc[nearby] += self._gaussian(dr2, var[None, :]).dot(norm)
+
+        return conc
+
+    def rasterize(self):
+        """Calculate conc over the whole environment grid from the current puffs.
+
+        Puffs are separable Gaussians, so each chunk of puffs is summed with a single
+        matrix product of per-axis profiles."""
+        conc = np.zeros((self.env.nx, self.env.ny * self.env.nz), dtype=float)
+
+        for start in range(0, self.n_puffs, self.chunk_size):
+            pos = self.puff_pos[start:min(start + self.chunk_size, self.n_puffs)]
+            var = self.puff_var[start:min(start + self.chunk_size, self.n_puffs)]
+            norm = self.q / (2 * np.pi * var)**(self.dim / 2.)
+
+            gx = self._gaussian((self.env.x[None, :] - pos[:, 0:1])**2, var[:, None])
+            gy = self._gaussian((self.env.y[None, :] - pos[:, 1:2])**2, var[:, None])
+            if self.dim == 3:
+                gz = self._gaussian((self.env.z[None, :] - pos[:, 2:3])**2, var[:, None])
+            else:
+                gz = np.ones((len(pos), 1))
+
+            gyz = (gy[:, :, None] * (gz * norm[:, None])[:, None, :]).reshape(len(pos), -1)
+            conc += gx.T.dot(gyz)
+
+        self.conc = conc.reshape(self.env.shape).astype(self.dtype, copy=False)
+        self._conc_ts = self.ts
+
+        return self.conc
+
+    def _current_conc(self):
+        if self._conc_ts != self.ts:
+            self.rasterize()
+        return self.conc
+
+    @property
+    def concxy(self):
+        return self._current_conc()[:, :, self.env.center_zidx]
+
+    @property
+    def concxz(self):
+        return self._current_conc()[:, self.env.center_yidx, :]
+
+    @property
+    def concyz(self):
+        return self._current_conc()[self.env.center_xidx, :, :]
+
+    def conc_at_idxs(self, pos_idxs):
+        pos_idxs = np.asarray(pos_idxs, dtype=int).reshape(-1, 3)
+        positions = np.array([self.env.x[pos_idxs[:, 0]], self.env.y[pos_idxs[:, 1]], self.env.z[pos_idxs[:, 2]]]).T
+
+        return self.conc_at(positions)
+
+    def sample(self, pos_idx):
+        return self.sample_many([pos_idx])[0]
@@ -0,0 +1,128 @@
+"""
+Batched simulation of many independent searchers in the same plume.
+
+All searchers' position idxs are stored in a single (N, 3) array, odor is sampled
+for all of them at once with Plume.sample_many, and they are moved with vectorized
+movement rules. Searchers that leave the environment or reach the source are
+masked out in bulk.
+"""
+
+import numpy as np
+
+
+# unit lattice steps along each axis, in the order +x, -x, +y, -y, +z, -z
+LATTICE_STEPS = np.array([[1, 0, 0], [-1, 0, 0],
+                          [0, 1, 0], [0, -1, 0],
+                          [0, 0, 1], [0, 0, -1]], dtype=int)
+
+
+def random_walk_rule(population, odors):
+    """Move each searcher one lattice step in a random direction, ignoring odor."""
+    n_dirs = 2 * population.plume.dim
+    return LATTICE_STEPS[population.rng.integers(0, n_dirs, (len(odors),))]
+
+
+def surge_cast_rule(population, odors):
+    """Move searchers that detected odor one step upwind (-x), and the others one
+    step in a random crosswind direction."""
+    n_cast_dirs = 2 * (population.plume.dim - 1)
+    steps = LATTICE_STEPS[2 + population.rng.integers(0, n_cast_dirs, (len(odors),))]
+    steps[odors > 0] = LATTICE_STEPS[1]
+
+    return steps
+
+
+class SearcherPopulation(object):
+    """Population of independent searchers moving through a plume.
+
+    Args:
+        plume: initialized plume whose sample_many is used to draw odors
+        n_agents: number of searchers
+        n_steps: maximum number of timesteps to record
+        rule: function taking (population, odors) and returning an (N, 3) int array
+            of steps for the searchers that are still active
+        seed: seed of random number generator used for movement
+        record_positions: whether to keep the position of every searcher at every
+            timestep (this takes n_steps * n_agents * 3 ints)
+    """
+
+    def __init__(self, plume, n_agents, n_steps, rule=random_walk_rule, seed=None, record_positions=False):
+        self.plume = plume
+        self.env = plume.env
+        self.n_agents = n_agents
+        self.n_steps = n_steps
+        self.rule = rule
+        self.rng = np.random.default_rng(seed)
+        self.record_positions = record_positions
+
+        # preallocate state & history arrays
+        self.pos_idxs = np.zeros((n_agents, 3), dtype=int)
+        self.active = np.zeros((n_agents,), dtype=bool)
+        self.found_ts = np.zeros((n_agents,), dtype=int)
+        self.exit_ts = np.zeros((n_agents,), dtype=int)
+
+        # odor histories are -1 for searchers that were no longer active
+        self.odor_history = np.zeros((n_steps, n_agents), dtype=np.int16)
+        if record_positions:
+            self.pos_history = np.zeros((n_steps, n_agents, 3), dtype=np.int32)
+        else:
+            self.pos_history = None
+
+        self.ts = 0
+
+    def reset(self, start_pos_idxs):
+        """Place all searchers at their starting position idxs (a single idx or an
+        (N, 3) array) and clear their histories."""
+        self.pos_idxs[:] = np.asarray(start_pos_idxs, dtype=int).reshape(-1, 3)
+        self.active[:] = ~self.env.idxs_out_of_bounds(self.pos_idxs)
+        self.found_ts[:] = -1
+        self.exit_ts[:] = -1
+        self.odor_history[:] = -1
+        if self.record_positions:
+            self.pos_history[:] = -1
+
+        self.ts = 0
+        self._check_found()
+
+    def _check_found(self):
+        found = self.active & np.all(self.pos_idxs == self.plume.src_pos_idx, axis=1)
+        self.found_ts[found] = self.ts
+        self.active[found] = False
+
+    def step(self):
+        """Sample odor for all active searchers, record it, and move them."""
+        if self.ts >= self.n_steps:
+            raise IndexError('Population has already run for all {} timesteps!'.format(self.n_steps))
+
+        active_idxs = self.active.nonzero()[0]
+        if self.record_positions:
+            self.pos_history[self.ts, active_idxs] = self.pos_idxs[active_idxs]
+
+        # sample & record odor
+        odors = self.plume.sample_many(self.pos_idxs[active_idxs])
+        self.odor_history[self.ts, active_idxs] = odors
+
+        # move searchers, and deactivate the ones that left the environment
+        new_pos_idxs = self.pos_idxs[active_idxs] + self.rule(self, odors)
+        out_of_bounds = self.env.idxs_out_of_bounds(new_pos_idxs)
+
+        self.pos_idxs[active_idxs[~out_of_bounds]] = new_pos_idxs[~out_of_bounds]
+        self.active[active_idxs[out_of_bounds]] = False
+        self.exit_ts[active_idxs[out_of_bounds]] = self.ts
+
+        self.plume.update()
+        self.ts += 1
+        self._check_found()
+
+    def run(self, n_steps=None):
+        """Step until n_steps (default: all remaining) timesteps have passed or no
+        searchers are active anymore."""
+        if n_steps is None:
+            n_steps = self.n_steps - self.ts
+
+        for _ in range(n_steps):
+            if not self.active.any():
+                break
+            self.step()
+
+        return self
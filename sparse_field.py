@@ -0,0 +1,450 @@
+"""
+Memory-saving storage for plume fields that are mostly background.
+
+A field is stored as a constant background value plus either a dense bounding box
+(BoxField) or a block-sparse tiling (BlockSparseField) of the voxels that differ
+from the background by more than a tolerance. Both are built one x-slab at a time,
+so the full dense field never has to fit in memory, and both support numpy-style
+indexing (field[...]) with integers, integer arrays and slices, returning what the
+dense field would.
+
+Fields with a closed form can instead be stored as an AnalyticField, which stores
+nothing and evaluates the formula at whichever voxels are indexed (optionally keeping
+a bounded LRU cache of recently evaluated voxels, see VoxelCache).
+"""
+
+import numpy as np
+
+
+class SparseField(object):
+    """Base class for read-only 3D fields with a background value.
+
+    Subclasses implement _lookup(ix, iy, iz), which returns the values at broadcastable
+    arrays of in-bounds idxs.
+    """
+
+    ndim = 3
+
+    def __init__(self, shape, background, dtype):
+        self.shape = tuple(shape)
+        self.background = background
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if any(k is Ellipsis for k in key):
+            pos = [k is Ellipsis for k in key].index(True)
+            key = key[:pos] + (slice(None),) * (self.ndim - len(key) + 1) + key[pos + 1:]
+
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for field of shape {}'.format(self.shape))
+
+        return tuple(key) + (slice(None),) * (self.ndim - len(key))
+
+    @staticmethod
+    def _check_idxs(idxs, n):
+        idxs = np.asarray(idxs)
+        if not np.issubdtype(idxs.dtype, np.integer):
+            raise IndexError('only integers, integer arrays and slices are valid indices')
+
+        idxs = np.where(idxs < 0, idxs + n, idxs)
+        if np.any((idxs < 0) | (idxs >= n)):
+            raise IndexError('index out of bounds for axis with size {}'.format(n))
+
+        return idxs
+
+    def __getitem__(self, key):
+        key = self._normalize_key(key)
+
+        # only integers and integer arrays: pointwise lookup
+        if not any(isinstance(k, slice) for k in key):
+            return self._lookup(*[self._check_idxs(k, n) for k, n in zip(key, self.shape)])[()]
+
+        # otherwise look up the outer product of the idxs used along each axis and
+        # index that with the key, relabeled to point into it
+        axis_idxs = []
+        sub_key = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                axis_idxs += [np.arange(n)[k]]
+                sub_key += [slice(None)]
+            else:
+                k = self._check_idxs(k, n)
+                unique_idxs, inverse = np.unique(k, return_inverse=True)
+                axis_idxs += [unique_idxs]
+                sub_key += [int(inverse.reshape(-1)[0]) if k.ndim == 0 else inverse.reshape(k.shape)]
+
+        return self._lookup(*np.ix_(*axis_idxs))[tuple(sub_key)]
+
+    def toarray(self, slab_size=16):
+        """Return the field as a dense array."""
+        conc = np.empty(self.shape, dtype=self.dtype)
+        for x0 in range(0, self.shape[0], slab_size):
+            conc[x0:x0 + slab_size] = self[x0:x0 + slab_size]
+
+        return conc
+
+    def __array__(self, dtype=None, copy=None):
+        conc = self.toarray()
+        if dtype is not None:
+            conc = conc.astype(dtype, copy=False)
+
+        return conc
+
+    def _stored_values(self):
+        """Yield arrays of all the field's values other than the background."""
+        for x0 in range(0, self.shape[0], 16):
+            yield self[x0:x0 + 16]
+
+    def _has_background(self):
+        """Return whether any voxel is only stored implicitly, as the background."""
+        return False
+
+    def _reduce(self, func):
+        values = [func(v) for v in self._stored_values() if v.size]
+        if self._has_background():
+            values += [self.background]
+
+        return self.dtype.type(func(np.array(values, dtype=self.dtype)))
+
+    def max(self):
+        """Return the maximum of the field, from the stored values and the background
+        (without building the dense field)."""
+        return self._reduce(np.max)
+
+    def min(self):
+        """Return the minimum of the field, from the stored values and the background
+        (without building the dense field)."""
+        return self._reduce(np.min)
+
+
+def _slab_bounds(n, slab_size):
+    for x0 in range(0, n, slab_size):
+        yield x0, min(x0 + slab_size, n)
+
+
+class BoxField(SparseField):
+    """Field stored as a dense box, with a background value outside it.
+
+    Args:
+        shape: shape of the full field
+        box_start: idx of the first voxel of the box
+        box: dense values inside the box
+        background: value outside the box
+        dtype: dtype of the field
+    """
+
+    def __init__(self, shape, box_start, box, background, dtype=float):
+        super().__init__(shape, background, dtype)
+        self.box_start = tuple(int(i) for i in box_start)
+        self.box = np.asarray(box, dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        return self.box.nbytes
+
+    @classmethod
+    def from_slabs(cls, shape, slab_func, background=0., tol=0., slab_size=16, dtype=float):
+        """Build the smallest box containing all voxels that differ from the background
+        by more than tol.
+
+        The field is calculated twice, one slab at a time: once to find the box and once
+        to fill it.
+
+        Args:
+            shape: shape of the full field
+            slab_func: function returning the field over x idxs x0:x1 (an array of shape
+                (x1 - x0, ny, nz)) when called as slab_func(x0, x1)
+            background: value outside the box
+            tol: voxels that differ from the background by at most this much may be
+                replaced by it
+            slab_size: number of x idxs per slab
+            dtype: dtype of the field
+        """
+        lower = np.array(shape)
+        upper = np.zeros((3,), dtype=int)
+
+        for x0, x1 in _slab_bounds(shape[0], slab_size):
+            keep = np.abs(np.asarray(slab_func(x0, x1)) - background) > tol
+            for axis in range(3):
+                kept = np.any(keep, axis=tuple(a for a in range(3) if a != axis)).nonzero()[0]
+                if len(kept):
+                    offset = x0 if axis == 0 else 0
+                    lower[axis] = min(lower[axis], kept[0] + offset)
+                    upper[axis] = max(upper[axis], kept[-1] + offset + 1)
+
+        if np.any(upper <= lower):
+            return cls(shape, (0, 0, 0), np.zeros((0, 0, 0), dtype=dtype), background, dtype)
+
+        box = np.empty(upper - lower, dtype=dtype)
+        for x0, x1 in _slab_bounds(upper[0] - lower[0], slab_size):
+            slab = slab_func(lower[0] + x0, lower[0] + x1)
+            box[x0:x1] = slab[:, lower[1]:upper[1], lower[2]:upper[2]]
+
+        return cls(shape, lower, box, background, dtype)
+
+    def _stored_values(self):
+        yield self.box
+
+    def _has_background(self):
+        return self.box.shape != self.shape
+
+    def _lookup(self, ix, iy, iz):
+        if self.box.size == 0:
+            return np.full(np.broadcast_shapes(ix.shape, iy.shape, iz.shape), self.background, dtype=self.dtype)
+
+        inside = True
+        box_idxs = []
+        for idxs, start, n in zip((ix, iy, iz), self.box_start, self.box.shape):
+            idxs = idxs - start
+            inside = inside & (idxs >= 0) & (idxs < n)
+            box_idxs += [np.clip(idxs, 0, n - 1)]
+
+        return np.where(inside, self.box[tuple(box_idxs)], self.dtype.type(self.background))
+
+
+class BlockSparseField(SparseField):
+    """Field stored as a tiling of equal-size blocks, in which only blocks containing
+    voxels that differ from the background are stored.
+
+    Args:
+        shape: shape of the full field
+        block_shape: shape of each block
+        block_idxs: idx into blocks of each block of the tiling; 0 is a block filled
+            with the background value
+        blocks: (n_blocks,) + block_shape array of stored blocks
+        background: value of background voxels
+        dtype: dtype of the field
+    """
+
+    def __init__(self, shape, block_shape, block_idxs, blocks, background, dtype=float):
+        super().__init__(shape, background, dtype)
+        self.block_shape = tuple(block_shape)
+        self.block_idxs = block_idxs
+        self.blocks = np.asarray(blocks, dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        return self.blocks.nbytes + self.block_idxs.nbytes
+
+    @classmethod
+    def from_slabs(cls, shape, slab_func, background=0., tol=0., block_shape=(16, 16, 16), dtype=float):
+        """Build a block-sparse field storing only the blocks that contain voxels that
+        differ from the background by more than tol.
+
+        Args:
+            shape: shape of the full field
+            slab_func: function returning the field over x idxs x0:x1 (an array of shape
+                (x1 - x0, ny, nz)) when called as slab_func(x0, x1)
+            background: value of background voxels
+            tol: voxels that differ from the background by at most this much may be
+                replaced by it
+            block_shape: shape of each block
+            dtype: dtype of the field
+        """
+        bx, by, bz = block_shape
+        nx, ny, nz = shape
+        nbx, nby, nbz = -(-nx // bx), -(-ny // by), -(-nz // bz)
+
+        block_idxs = np.zeros((nbx, nby, nbz), dtype=np.int32)
+
+        # blocks are stored in an array that grows (in place if possible) as needed
+        blocks = np.empty((16,) + tuple(block_shape), dtype=dtype)
+        blocks[0] = background
+        n_blocks = 1
+
+        # slabs are padded with background to a whole number of blocks
+        slab = np.empty((bx, nby * by, nbz * bz), dtype=dtype)
+        tiles = slab.reshape(bx, nby, by, nbz, bz)
+
+        for bxidx, (x0, x1) in enumerate(_slab_bounds(nx, bx)):
+            slab[:] = background
+            slab[:x1 - x0, :ny, :nz] = slab_func(x0, x1)
+
+            keep = np.any(np.abs(tiles - background) > tol, axis=(0, 2, 4))
+            byidxs, bzidxs = keep.nonzero()
+
+            if n_blocks + len(byidxs) > len(blocks):
+                blocks.resize((max(n_blocks + len(byidxs), len(blocks) * 3 // 2),) + blocks.shape[1:], refcheck=False)
+
+            # (the advanced idxs are separated by a slice, so the block axis comes first)
+            block_idxs[bxidx, byidxs, bzidxs] = np.arange(n_blocks, n_blocks + len(byidxs))
+            blocks[n_blocks:n_blocks + len(byidxs)] = tiles[:, byidxs, :, bzidxs, :]
+            n_blocks += len(byidxs)
+
+        blocks.resize((n_blocks,) + blocks.shape[1:], refcheck=False)
+
+        return cls(shape, block_shape, block_idxs, blocks, background, dtype)
+
+    def _stored_values(self):
+        # blocks at the upper edges are padded with background beyond the field, so
+        # only their in-bounds parts count
+        block_pos = np.zeros((len(self.blocks), 3), dtype=int)
+        block_pos[self.block_idxs.ravel()] = np.array(np.unravel_index(np.arange(self.block_idxs.size),
+                                                                       self.block_idxs.shape)).T
+        extents = np.minimum(np.array(self.block_shape), np.array(self.shape) - block_pos * self.block_shape)
+
+        interior = np.all(extents == self.block_shape, axis=1)
+        interior[0] = False
+        yield self.blocks[interior]
+
+        for block_idx in (~interior).nonzero()[0][1:]:
+            ex, ey, ez = extents[block_idx]
+            yield self.blocks[block_idx, :ex, :ey, :ez]
+
+    def _has_background(self):
+        return bool(np.any(self.block_idxs == 0))
+
+    def _lookup(self, ix, iy, iz):
+        bx, by, bz = self.block_shape
+        block_idxs = self.block_idxs[ix // bx, iy // by, iz // bz]
+
+        return self.blocks[block_idxs, ix % bx, iy % by, iz % bz]
+
+
+class VoxelCache(object):
+    """Bounded least-recently-used cache of field values by flat (C order) voxel idx.
+
+    Keys are kept in a sorted array so that a whole batch of idxs is looked up at once
+    with searchsorted; inserting a batch of misses (and evicting the least recently
+    used voxels beyond capacity) costs time linear in the capacity, so the cache pays
+    off for batches of idxs rather than single voxels.
+
+    Args:
+        capacity: max number of voxel values to keep
+        dtype: dtype of the values
+    """
+
+    def __init__(self, capacity, dtype=float):
+        if capacity < 1:
+            raise ValueError('Capacity must be positive!')
+
+        self.capacity = int(capacity)
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self.values = np.zeros((0,), dtype=dtype)
+        self.last_used = np.zeros((0,), dtype=np.int64)
+
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.values.nbytes + self.last_used.nbytes
+
+    def get(self, flat_idxs, evaluate):
+        """Return the values at an array of flat voxel idxs, calling evaluate(flat_idxs)
+        with an array of the unique idxs that aren't cached to calculate them."""
+        flat_idxs = np.asarray(flat_idxs, dtype=np.int64)
+        unique_idxs, inverse = np.unique(flat_idxs, return_inverse=True)
+        self.clock += 1
+
+        slots = np.searchsorted(self.keys, unique_idxs)
+        hit = slots < len(self.keys)
+        hit[hit] = self.keys[slots[hit]] == unique_idxs[hit]
+
+        values = np.empty(unique_idxs.shape, dtype=self.values.dtype)
+        values[hit] = self.values[slots[hit]]
+        self.last_used[slots[hit]] = self.clock
+
+        miss = ~hit
+        if miss.any():
+            values[miss] = evaluate(unique_idxs[miss])
+            self._insert(slots[miss], unique_idxs[miss], values[miss])
+
+        n_hits = int(hit.sum())
+        self.hits += n_hits
+        self.misses += len(unique_idxs) - n_hits
+
+        return values[inverse.reshape(flat_idxs.shape)]
+
+    def _insert(self, slots, keys, values):
+        # the new keys are sorted & not cached, so inserting them at their slots keeps
+        # the keys sorted
+        self.keys = np.insert(self.keys, slots, keys)
+        self.values = np.insert(self.values, slots, values)
+        self.last_used = np.insert(self.last_used, slots, self.clock)
+
+        n_evict = len(self.keys) - self.capacity
+        if n_evict > 0:
+            keep = np.sort(np.argpartition(self.last_used, n_evict)[n_evict:])
+            self.keys = self.keys[keep]
+            self.values = self.values[keep]
+            self.last_used = self.last_used[keep]
+
+
+class AnalyticField(SparseField):
+    """Field given by a closed-form function of position, which is evaluated at
+    whichever voxels are indexed instead of being stored.
+
+    Args:
+        x, y, z: coordinates of the voxel centers along each axis
+        func: function returning the field at broadcastable arrays of x, y and z
+            coordinates when called as func(x, y, z)
+        background: value of the field far from the source
+        cache_size: max number of recently evaluated voxel values to cache (see
+            VoxelCache), or 0 for no cache
+        dtype: dtype of the field
+    """
+
+    def __init__(self, x, y, z, func, background=0., cache_size=0, dtype=float):
+        super().__init__((len(x), len(y), len(z)), background, dtype)
+        self.coords = (np.asarray(x), np.asarray(y), np.asarray(z))
+        self.func = func
+        self.cache = VoxelCache(cache_size, self.dtype) if cache_size else None
+
+    @property
+    def nbytes(self):
+        return self.cache.nbytes if self.cache is not None else 0
+
+    def _stored_values(self):
+        # evaluated directly, so as not to flush the cache
+        for x0 in range(0, self.shape[0], 16):
+            yield self._evaluate(*np.ix_(np.arange(x0, min(x0 + 16, self.shape[0])),
+                                         np.arange(self.shape[1]), np.arange(self.shape[2])))
+
+    def max(self):
+        """Return the maximum of the field. Since nothing is stored, this evaluates the
+        whole grid (one slab at a time, so without building the dense field)."""
+        return self._reduce(np.max)
+
+    def min(self):
+        """Return the minimum of the field. Since nothing is stored, this evaluates the
+        whole grid (one slab at a time, so without building the dense field)."""
+        return self._reduce(np.min)
+
+    def at(self, positions):
+        """Return the field at each row of an (N, 3) array of continuous positions (which
+        needn't be inside the grid)."""
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+
+        return np.asarray(self.func(positions[:, 0], positions[:, 1], positions[:, 2]), dtype=self.dtype)
+
+    def _evaluate(self, ix, iy, iz):
+        shape = np.broadcast_shapes(ix.shape, iy.shape, iz.shape)
+
+        # evaluate on arrays even for single voxels, since func may handle them differently
+        x, y, z = (c[np.atleast_1d(i)] for c, i in zip(self.coords, (ix, iy, iz)))
+        values = np.asarray(self.func(x, y, z), dtype=self.dtype)
+
+        return np.broadcast_to(values, np.broadcast_shapes(x.shape, y.shape, z.shape)).reshape(shape)
+
+    def _lookup(self, ix, iy, iz):
+        if self.cache is None:
+            return self._evaluate(ix, iy, iz)
+
+        flat_idxs = np.ravel_multi_index(np.broadcast_arrays(ix, iy, iz), self.shape)
+
+        return self.cache.get(flat_idxs, lambda f: self._evaluate(*np.unravel_index(f, self.shape)))
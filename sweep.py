@@ -0,0 +1,217 @@
+"""
+Parallel parameter sweeps over plumes.
+
+Parameter points are spread across a ProcessPoolExecutor. The environment's bin
+arrays (and any other large arrays the task needs, such as precomputed fields)
+are put in shared memory once, and every worker process attaches to them instead
+of receiving pickled copies. Results are yielded as they finish, and can be
+appended to a JSON-lines results file from which a partial sweep can be resumed.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import plume
+
+
+class SharedArrays(object):
+    """Copies of numpy arrays in shared memory blocks, which other processes can
+    attach to (see attach_shared_arrays) without copying.
+
+    Use as a context manager, or call close() when done; this frees the blocks.
+
+    Args:
+        arrays: dict of arrays by name
+    """
+
+    def __init__(self, arrays):
+        self.blocks = {}
+        self.specs = {}
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach_shared_arrays(specs):
+    """Attach to arrays made by SharedArrays, given their specs.
+
+    Returns:
+        dict of read-only arrays by name, and the list of shared memory blocks
+        backing them (which must be kept alive as long as the arrays are used)"""
+    arrays = {}
+    blocks = []
+
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False
+
+        arrays[name] = array
+        blocks += [block]
+
+    return arrays, blocks
+
+
+# state set up once in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(specs, env_dtype):
+    shared, blocks = attach_shared_arrays(specs)
+
+    _worker_state['blocks'] = blocks
+    _worker_state['env'] = plume.Environment3d(shared.pop('xbins'), shared.pop('ybins'), shared.pop('zbins'),
+                                               dtype=env_dtype)
+    _worker_state['shared'] = shared
+
+
+def _run_task(task, params):
+    return task(_worker_state['env'], _worker_state['shared'], **params)
+
+
+def param_grid(**param_values):
+    """Return a list of parameter dicts, one for every combination of the given values.
+
+    Example:
+        param_grid(w=[0.2, 0.4], d=[0.1]) == [{'w': 0.2, 'd': 0.1}, {'w': 0.4, 'd': 0.1}]"""
+    names = list(param_values)
+    return [dict(zip(names, values)) for values in itertools.product(*param_values.values())]
+
+
+def _to_json(obj):
+    """Convert numpy scalars & arrays (e.g. values from np.linspace grids) for json."""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def params_key(params):
+    """Return a string identifying a parameter point."""
+    return json.dumps(params, sort_keys=True, default=_to_json)
+
+
+def point_seed(params, base_seed=0):
+    """Return a seed for a parameter point, derived from base_seed and the params, so
+    that every point gets its own random stream (whatever order points are run in)."""
+    digest = hashlib.sha1(params_key(params).encode()).digest()
+    return np.random.SeedSequence([base_seed, int.from_bytes(digest[:8], 'little')])
+
+
+def load_results(results_path):
+    """Load results from a JSON-lines results file written by run_sweep.
+
+    Returns:
+        dict of (params, result) tuples by params_key; empty if the file doesn't exist"""
+    results = {}
+    if results_path is None or not os.path.exists(results_path):
+        return results
+
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a partially written last line from an interrupted sweep
+                continue
+            results[params_key(record['params'])] = (record['params'], record['result'])
+
+    return results
+
+
+def run_sweep(task, param_points, env, shared_arrays=None, results_path=None, max_workers=None):
+    """Run a task for every parameter point in parallel, yielding results as they finish.
+
+    Args:
+        task: picklable (i.e. module-level) function called as
+            task(env, shared, **params), where env is an Environment3d whose bins live
+            in shared memory and shared is a dict of read-only shared arrays; it must
+            return something JSON-serializable if results_path is given
+        param_points: list of parameter dicts (e.g. from param_grid)
+        env: Environment3d to share with the workers
+        shared_arrays: optional dict of other arrays to share with the workers
+        results_path: optional JSON-lines file to append each result to; points whose
+            results are already in it are skipped, so an interrupted sweep can be resumed
+        max_workers: number of worker processes (defaults to number of CPUs)
+
+    Yields:
+        (params, result) tuples, in order of completion
+    """
+    done = load_results(results_path)
+    todo = [params for params in param_points if params_key(params) not in done]
+    if not todo:
+        return
+
+    arrays = {'xbins': env.xbins, 'ybins': env.ybins, 'zbins': env.zbins}
+    arrays.update(shared_arrays or {})
+
+    with SharedArrays(arrays) as shared:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(shared.specs, env.dtype.str)) as pool:
+
+            futures = {pool.submit(_run_task, task, params): params for params in todo}
+
+            for future in as_completed(futures):
+                params = futures[future]
+                result = future.result()
+
+                if results_path is not None:
+                    with open(results_path, 'a') as f:
+                        f.write(json.dumps({'params': params, 'result': result}, default=_to_json) + '\n')
+
+                yield params, result
+
+
+PLUME_CLASSES = {cls.name: cls for cls in (plume.BasicPlume, plume.SpreadingGaussianPlume,
+                                           plume.CollimatedPlume, plume.PuffPlume)}
+
+
+def plume_sampling_task(env, shared, plume_name, src_pos=(0., 0., 0.), n_samples=1000, seed=None, **params):
+    """Sweep task that initializes a plume with the given params and returns the mean
+    odor sampled at n_samples random position idxs.
+
+    If shared contains a 'pos_idxs' array, those position idxs are sampled instead.
+    Unless a seed is given, one is derived from all the other arguments (see
+    point_seed), so each parameter point gets its own random stream."""
+    if seed is None:
+        seed = point_seed(dict(params, plume_name=plume_name, src_pos=src_pos, n_samples=n_samples))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    # independent streams for the plume and the positions
+    plume_seed, position_seed = seed.spawn(2)
+
+    pl = PLUME_CLASSES[plume_name](env, seed=plume_seed)
+    pl.set_params(**params)
+    pl.set_src_pos(src_pos)
+    pl.initialize()
+
+    if 'pos_idxs' in shared:
+        pos_idxs = shared['pos_idxs']
+    else:
+        rng = np.random.default_rng(position_seed)
+        pos_idxs = np.array([rng.integers(0, n, (n_samples,)) for n in env.shape]).T
+
+    return float(np.mean(pl.sample_many(pos_idxs)))
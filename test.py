@@ -1,10 +1,20 @@
 """Unit tests for plumes."""
 from __future__ import division, print_function
 
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
 import unittest
 import numpy as np
 from scipy.stats import multivariate_normal as mvn
 import plume
+import logprob_odor
+import field_cache
+import instrumentation
+import searchers
+import sweep
 
 
 class TruismsTestCase(unittest.TestCase):
@@ -16,6 +26,16 @@ class TruismsTestCase(unittest.TestCase):
         self.assertFalse(False)
 
 
+class ImportTestCase(unittest.TestCase):
+
+    def test_importing_plume_does_not_import_scipy(self):
+        code = 'import sys, plume; print(any(m.startswith("scipy") for m in sys.modules))'
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self.assertEqual(output.strip(), 'False')
+
+
 class Environment3dTestCase(unittest.TestCase):
 
     def test_pos_to_idx_conversion(self):
@@ -47,6 +67,37 @@ class Environment3dTestCase(unittest.TestCase):
                                              env.idx_from_pos(pos),
                                              decimal=5)
 
+    def test_vectorized_pos_to_idx_conversion_matches_scalar(self):
+
+        xrbins = np.linspace(0, 10., 11)
+        yrbins = np.linspace(0, 5., 6)
+        zrbins = np.linspace(0, 5., 6)
+
+        env = plume.Environment3d(xrbins, yrbins, zrbins)
+
+        # include positions well outside the environment to check clamping
+        positions = np.random.uniform(-3, 13, (500, 3))
+
+        idxs = env.idxs_from_positions(positions)
+        true_idxs = np.array([env.idx_from_pos(pos) for pos in positions])
+
+        np.testing.assert_array_equal(idxs, true_idxs)
+
+    def test_vectorized_out_of_bounds_matches_scalar(self):
+
+        xrbins = np.linspace(0, 10., 11)
+        yrbins = np.linspace(0, 5., 6)
+        zrbins = np.linspace(0, 5., 6)
+
+        env = plume.Environment3d(xrbins, yrbins, zrbins)
+
+        pos_idxs = np.random.randint(-2, 12, (500, 3))
+
+        mask = env.idxs_out_of_bounds(pos_idxs)
+        true_mask = np.array([env.idx_out_of_bounds(pos_idx) for pos_idx in pos_idxs])
+
+        np.testing.assert_array_equal(mask, true_mask)
+
     def test_extent_correctly_set(self):
 
         xbinmin = -1.
@@ -78,6 +129,58 @@ class Environment3dTestCase(unittest.TestCase):
         self.assertEqual(zbinmax, env.extentyz[3])
 
 
+class NonUniformEnvironmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = plume.Environment3d.refined((-0.3, 1.0), (-0.15, 0.15), (-0.15, 0.15), (0.01, 0., 0.),
+                                               min_width=.005, max_width=.05, growth=1.4)
+
+    def test_refined_bins_are_finest_around_source(self):
+        self.assertFalse(self.env.uniform)
+
+        for bins, lim, center in zip((self.env.xbins, self.env.ybins, self.env.zbins),
+                                     ((-0.3, 1.0), (-0.15, 0.15), (-0.15, 0.15)), (0.01, 0., 0.)):
+            widths = np.diff(bins)
+            self.assertTrue(np.all(widths > 0))
+            self.assertEqual((bins[0], bins[-1]), lim)
+            self.assertAlmostEqual(widths.min(), .005)
+            self.assertLessEqual(widths.max(), .05 * 1.5)
+
+            # the finest bin is centered on the source
+            finest = widths.argmin()
+            self.assertAlmostEqual(0.5 * (bins[finest] + bins[finest + 1]), center)
+
+        self.assertEqual(self.env.pos_from_idx(self.env.idx_from_pos((0.01, 0., 0.))), (0.01, 0., 0.))
+
+    def test_positions_are_assigned_to_the_bins_they_are_in(self):
+        positions = np.random.uniform([-0.4, -0.2, -0.2], [1.1, 0.2, 0.2], (1000, 3))
+        idxs = self.env.idxs_from_positions(positions)
+
+        for pos, idx in zip(positions, idxs):
+            for p, i, bins in zip(pos, idx, (self.env.xbins, self.env.ybins, self.env.zbins)):
+                true_i = np.clip(np.sum(bins <= p) - 1, 0, len(bins) - 2)
+                self.assertEqual(i, true_i)
+
+            self.assertEqual(self.env.idx_from_pos(pos), tuple(idx))
+
+    def test_plume_initialization_and_discretization(self):
+        pl = plume.BasicPlume(self.env)
+        pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+        pl.set_src_pos((0.01, 0., 0.))
+        pl.initialize()
+
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
+        mean_hit_rate = logprob_odor.advec_diff_mean_hit_rate(x - 0.01, y, z, 0.4, 10, 0.1, .002, 1000, dim=3)
+        np.testing.assert_allclose(pl.conc, mean_hit_rate, rtol=1e-12)
+
+        positions = np.array([0.35, 0, 0]) + np.random.normal(0, .005, (500, 3)).cumsum(axis=0)
+        pos_idxs = self.env.discretize_position_sequence(positions)
+
+        self.assertTrue(np.all(np.abs(np.diff(pos_idxs, axis=0)).sum(axis=1) == 1))
+        np.testing.assert_array_equal(pos_idxs[0], self.env.idxs_from_positions(positions[:1])[0])
+        np.testing.assert_array_equal(pos_idxs[-1], self.env.idxs_from_positions(positions[-1:])[0])
+
+
 class SimplePlumeTestCase(unittest.TestCase):
 
     def test_collimated_plume(self):
@@ -123,6 +226,770 @@ class SimplePlumeTestCase(unittest.TestCase):
         self.assertAlmostEqual(pl.conc[(3, 6, 11)], pl.conc[(38, 6, 11)])
 
 
+class PlumeInitializationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 101)
+        ybins = np.linspace(-0.15, 0.15, 41)
+        zbins = np.linspace(-0.15, 0.15, 41)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.pl = plume.BasicPlume(self.env)
+        self.pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+        self.pl.set_src_pos((0.01, 0.01, 0.01))
+
+    def test_basic_plume_matches_full_meshgrid_calculation(self):
+        self.pl.initialize()
+
+        x, y, z = np.meshgrid(self.env.x, self.env.y, self.env.z, indexing='ij')
+        mean_hit_rate = logprob_odor.advec_diff_mean_hit_rate(x - self.pl.srcx, y - self.pl.srcy, z - self.pl.srcz,
+                                                              0.4, 10, 0.1, .002, 1000, dim=3)
+
+        np.testing.assert_allclose(self.pl.mean_hit_rate, mean_hit_rate, rtol=1e-12)
+
+    def test_initialization_peak_memory_is_about_one_field(self):
+        pl_spreading = plume.SpreadingGaussianPlume(self.env)
+        pl_spreading.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                                alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                                x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                                bkgd=400, threshold=450)
+
+        for pl in (self.pl, pl_spreading):
+            tracemalloc.start()
+            pl.initialize()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.assertLess(peak, 1.5 * pl.conc.nbytes)
+
+
+class SparseStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 51)
+        ybins = np.linspace(-0.15, 0.15, 41)
+        zbins = np.linspace(-0.15, 0.15, 21)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+    def make_plumes(self):
+        pl_spreading = plume.SpreadingGaussianPlume(self.env, seed=0)
+        pl_spreading.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                                alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                                x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                                bkgd=400, threshold=450)
+
+        pl_basic = plume.BasicPlume(self.env, seed=0)
+        pl_basic.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+        pl_basic.set_src_pos((0., 0., 0.))
+
+        pl_collimated_poisson = plume.CollimatedPoissonPlume(self.env, seed=0)
+        pl_collimated_poisson.set_aux_params(width=.0001, peak=100, max_hit_number=1)
+        pl_collimated_poisson.set_src_pos((0.5, 0., 0.))
+
+        return [pl_spreading, pl_basic, pl_collimated_poisson]
+
+    def test_sparse_fields_match_dense_fields(self):
+        pos_idxs = np.array([np.random.randint(0, n, (200,)) for n in self.env.shape]).T
+        keys = [(3, 4, 5), (-1, 0, -2), (slice(None), slice(None), self.env.center_zidx),
+                (slice(2, 40, 3), 7), (Ellipsis, np.array([1, 5, 5])), (pos_idxs[:, 0], slice(None), pos_idxs[0, 2])]
+
+        for storage, tol in (('box', 0.), ('block', 0.), ('box', 1.), ('block', 1.)):
+            for pl_dense, pl_sparse in zip(self.make_plumes(), self.make_plumes()):
+                with np.errstate(divide='ignore'):
+                    pl_dense.initialize()
+                    pl_sparse.set_storage(storage, tol=tol, block_shape=(8, 8, 8))
+                    pl_sparse.initialize()
+
+                dense = pl_dense.conc
+                sparse = pl_sparse.conc
+                self.assertIsInstance(sparse, plume.sparse_field.SparseField)
+                self.assertEqual(sparse.shape, dense.shape)
+                self.assertEqual(sparse.dtype, dense.dtype)
+
+                np.testing.assert_allclose(np.asarray(sparse), dense, rtol=0, atol=tol)
+                self.assertEqual(sparse.max(), np.asarray(sparse).max())
+                self.assertEqual(sparse.min(), np.asarray(sparse).min())
+                for key in keys:
+                    np.testing.assert_allclose(sparse[key], dense[key], rtol=0, atol=tol)
+                np.testing.assert_allclose(pl_sparse.concxy, pl_dense.concxy, rtol=0, atol=tol)
+
+                if tol == 0:
+                    np.testing.assert_array_equal(pl_sparse.sample_many(pos_idxs), pl_dense.sample_many(pos_idxs))
+                    self.assertEqual(pl_sparse.sample(pos_idxs[0]), pl_dense.sample(pos_idxs[0]))
+
+    def test_sparse_fields_are_smaller(self):
+        for storage in ('box', 'block'):
+            pl_basic, pl_collimated_poisson = self.make_plumes()[1:]
+            pl_basic.set_storage(storage, tol=1., block_shape=(8, 8, 8))
+            pl_collimated_poisson.set_storage(storage, tol=1e-3, block_shape=(8, 8, 8))
+
+            for pl in (pl_basic, pl_collimated_poisson):
+                with np.errstate(divide='ignore'):
+                    pl.initialize()
+                self.assertLess(pl.conc.nbytes, 0.5 * np.asarray(pl.conc).nbytes)
+
+                # max & min don't build the dense field
+                tracemalloc.start()
+                try:
+                    pl.conc.max()
+                    pl.conc.min()
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+                self.assertLess(peak, 0.5 * np.asarray(pl.conc).nbytes)
+
+    def test_analytic_fields_match_dense_fields(self):
+        pos_idxs = np.array([np.random.randint(0, n, (200,)) for n in self.env.shape]).T
+        keys = [(3, 4, 5), (slice(None), slice(None), self.env.center_zidx), (pos_idxs[:, 0], slice(None), 2)]
+
+        for cache_size in (0, 50):
+            for pl_dense, pl_analytic in zip(self.make_plumes()[:2], self.make_plumes()[:2]):
+                with np.errstate(divide='ignore'):
+                    pl_dense.initialize()
+                    pl_analytic.set_storage('analytic', cache_size=cache_size)
+                    pl_analytic.initialize()
+
+                self.assertIsInstance(pl_analytic.conc, plume.sparse_field.AnalyticField)
+                with np.errstate(divide='ignore'):
+                    for key in keys:
+                        np.testing.assert_allclose(pl_analytic.conc[key], pl_dense.conc[key])
+                    np.testing.assert_allclose(pl_analytic.concxy, pl_dense.concxy)
+                    self.assertEqual(pl_analytic.conc.max(), pl_dense.conc.max())
+                    self.assertAlmostEqual(pl_analytic.conc.min(), pl_dense.conc.min())
+
+                np.testing.assert_array_equal(pl_analytic.sample_many(pos_idxs), pl_dense.sample_many(pos_idxs))
+                self.assertEqual(pl_analytic.sample(pos_idxs[0]), pl_dense.sample(pos_idxs[0]))
+
+                if cache_size:
+                    self.assertLessEqual(len(pl_analytic.conc.cache), cache_size)
+
+        with self.assertRaises(ValueError):
+            self.make_plumes()[2].set_storage('analytic')
+
+    def test_analytic_fields_allocate_nothing(self):
+        # far too many voxels to store
+        env = plume.Environment3d(np.linspace(-1, 100, 100001), np.linspace(-5, 5, 10001), np.linspace(-5, 5, 10001))
+        pl = plume.BasicPlume(env, seed=0)
+        pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+        pl.set_src_pos((0., 0., 0.))
+        pl.set_storage('analytic', cache_size=100)
+        pl.initialize()
+        self.assertEqual(pl.conc.nbytes, 0)
+
+        pos_idxs = np.array([np.random.randint(0, n, (1000,)) for n in env.shape]).T
+        self.assertEqual(len(pl.sample_many(pos_idxs)), 1000)
+        self.assertEqual(len(pl.conc.cache), 100)
+
+        # recently evaluated voxels are cached
+        pl.conc_at_idxs(pos_idxs[-10:])
+        misses = pl.conc.cache.misses
+        conc = pl.conc_at_idxs(pos_idxs[-10:])
+        self.assertEqual(pl.conc.cache.misses, misses)
+        np.testing.assert_allclose(conc, pl.conc_at(np.array([env.x[pos_idxs[-10:, 0]], env.y[pos_idxs[-10:, 1]],
+                                                              env.z[pos_idxs[-10:, 2]]]).T))
+
+        # continuous positions are evaluated exactly, even outside the environment
+        self.assertGreater(pl.conc_at([[200., 0., 0.]])[0], 0)
+
+
+class SinglePrecisionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 53)
+        ybins = np.linspace(-0.15, 0.15, 21)
+        zbins = np.linspace(-0.15, 0.15, 21)
+        self.env_64 = plume.Environment3d(xbins, ybins, zbins)
+        self.env_32 = plume.Environment3d(xbins, ybins, zbins, dtype=np.float32)
+
+        self.params = {'dt': .1, 'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+
+    def assert_close_where_finite(self, x_32, x_64, rtol):
+        self.assertEqual(x_32.dtype, np.float32)
+        np.testing.assert_array_equal(np.isinf(x_32), np.isinf(x_64))
+
+        finite = np.isfinite(x_64)
+        np.testing.assert_allclose(x_32[finite], x_64[finite], rtol=rtol)
+
+    def test_plume_fields_close_to_double_precision(self):
+
+        for env in (self.env_64, self.env_32):
+            pl = plume.BasicPlume(env)
+            pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+            pl.set_src_pos((0., 0., 0.))
+            pl.initialize()
+
+            pl_spreading = plume.SpreadingGaussianPlume(env)
+            pl_spreading.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                                    alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                                    x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                                    bkgd=400, threshold=450)
+            pl_spreading.initialize()
+
+            if env is self.env_64:
+                conc_64, conc_spreading_64 = pl.conc, pl_spreading.conc
+            else:
+                conc_32, conc_spreading_32 = pl.conc, pl_spreading.conc
+
+        # only compare rates that are representable in single precision
+        normal = conc_64 > np.finfo(np.float32).tiny
+        self.assert_close_where_finite(conc_32[normal], conc_64[normal], rtol=1e-5)
+        self.assert_close_where_finite(conc_spreading_32, conc_spreading_64, rtol=1e-5)
+
+    def test_log_probs_close_to_double_precision(self):
+        env = self.env_64
+
+        for odor in (0, 1):
+            for pos_idx in ((0, 0, 0), (10, 10, 10), (51, 3, 17)):
+                lp_64 = logprob_odor.binary_advec_diff_tavg(odor, pos_idx, env.x, env.y, env.z, **self.params)
+                lp_32 = logprob_odor.binary_advec_diff_tavg(odor, pos_idx, env.x, env.y, env.z,
+                                                            dtype=np.float32, **self.params)
+                self.assert_close_where_finite(lp_32, lp_64, rtol=1e-4)
+
+        sp_64 = logprob_odor.SourcePosterior(self.env_64, **self.params)
+        sp_32 = logprob_odor.SourcePosterior(self.env_32, **self.params)
+        for pos_idx in ((10, 10, 10), (30, 8, 12), (40, 10, 9)):
+            sp_64.update(pos_idx, 1)
+            sp_32.update(pos_idx, 1)
+
+        self.assert_close_where_finite(sp_32.log_posterior, sp_64.log_posterior, rtol=1e-4)
+
+    def test_single_precision_log_probs_use_less_memory(self):
+        env = plume.Environment3d(np.linspace(-0.3, 1.0, 201), np.linspace(-0.15, 0.15, 81),
+                                  np.linspace(-0.15, 0.15, 81))
+
+        peaks = {}
+        for dtype in (float, np.float32):
+            tracemalloc.start()
+            try:
+                lp = logprob_odor.binary_advec_diff_tavg(1, (100, 40, 40), env.x, env.y, env.z, dtype=dtype,
+                                                         **self.params)
+                peaks[dtype] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            # little more than the result itself
+            self.assertLess(peaks[dtype], 1.5 * lp.nbytes)
+
+        self.assertLess(peaks[np.float32], 0.6 * peaks[float])
+
+    def test_hit_log_prob_is_accurate_for_small_mean_hit_numbers(self):
+        mean_hit_num = np.array([1e-12, 1e-8, 1e-4], dtype=np.float32)
+
+        lhit, lmiss = logprob_odor.binary_log_probs(mean_hit_num)
+
+        np.testing.assert_allclose(lhit, np.log(mean_hit_num), rtol=1e-4)
+        np.testing.assert_array_equal(lmiss, -mean_hit_num)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 27)
+        ybins = np.linspace(-0.15, 0.15, 13)
+        zbins = np.linspace(-0.15, 0.15, 9)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.pl = plume.BasicPlume(self.env, seed=0)
+        self.pl.set_params(w=0.4, r=10, d=0.1, a=.002, tau=1000)
+        self.pl.set_src_pos((0., 0., 0.))
+
+        instrumentation.reset()
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def test_calls_are_only_counted_when_enabled(self):
+        original_sample = plume.BasicPlume.sample
+        original_update = plume.Plume.update
+        original_kernel = logprob_odor.binary_advec_diff_log_probs
+
+        self.pl.initialize()
+        self.assertEqual(instrumentation.stats(), {})
+
+        calls = []
+        instrumentation.enable(callback=lambda name, elapsed: calls.append(name))
+
+        self.pl.initialize()
+        self.pl.sample_many(np.zeros((10, 3), dtype=int))
+        self.pl.sample((0, 0, 0))
+        self.pl.sample((1, 0, 0))
+        self.pl.update()
+        self.env.discretize_position_sequence(np.zeros((5, 3)))
+        logprob_odor.binary_advec_diff_tavg(1, (0, 0, 0), self.env.x, self.env.y, self.env.z,
+                                            dt=.1, w=0.4, r=10, d=0.1, a=.002, tau=1000)
+
+        instrumentation.disable()
+        self.pl.sample((0, 0, 0))
+
+        # while disabled, nothing is wrapped
+        self.assertIs(plume.BasicPlume.sample, original_sample)
+        self.assertIs(plume.Plume.update, original_update)
+        self.assertIs(logprob_odor.binary_advec_diff_log_probs, original_kernel)
+
+        stats = instrumentation.stats()
+        self.assertEqual(stats['BasicPlume.initialize']['calls'], 1)
+        self.assertEqual(stats['BasicPlume.sample_many']['calls'], 1)
+        self.assertEqual(stats['BasicPlume.sample']['calls'], 2)
+        # update is inherited from Plume but recorded under the instance's class
+        self.assertEqual(stats['BasicPlume.update']['calls'], 1)
+        self.assertEqual(stats['Environment3d.discretize_position_sequence']['calls'], 1)
+        self.assertEqual(stats['logprob_odor.binary_advec_diff_tavg']['calls'], 1)
+        # the fused kernel it calls is recorded too
+        self.assertEqual(stats['logprob_odor.binary_advec_diff_log_probs']['calls'], 1)
+
+        self.assertTrue(all(stat['time'] >= 0 for stat in stats.values()))
+        self.assertEqual(sorted(calls), sorted(name for name, stat in stats.items() for _ in range(stat['calls'])))
+
+
+class InterpolationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = plume.Environment3d(np.linspace(-0.3, 1.0, 27), np.linspace(-0.15, 0.15, 13),
+                                       np.linspace(-0.15, 0.15, 9))
+        self.env_2d = plume.Environment3d(np.linspace(-0.3, 1.0, 27), np.linspace(-0.15, 0.15, 13),
+                                          np.array([-0.01, 0.01]))
+
+    def test_linear_fields_are_interpolated_exactly_and_clamped(self):
+        for env in (self.env, self.env_2d):
+            pl = plume.EmptyPlume(env)
+            x, y, z = np.meshgrid(env.x, env.y, env.z, indexing='ij')
+            pl.load_field(2 * x - 3 * y + 5 * z + 1)
+
+            positions = np.random.uniform([-0.4, -0.2, -0.2], [1.1, 0.2, 0.2], (500, 3))
+            clamped = np.clip(positions, [env.x[0], env.y[0], env.z[0]], [env.x[-1], env.y[-1], env.z[-1]])
+            true_conc = 2 * clamped[:, 0] - 3 * clamped[:, 1] + 5 * clamped[:, 2] + 1
+
+            np.testing.assert_allclose(pl.conc_at(positions), true_conc, rtol=1e-10, atol=1e-12)
+
+            # at voxel centers interpolation just reads the field
+            pos_idxs = np.array([np.random.randint(0, n, (100,)) for n in env.shape]).T
+            centers = np.array([env.x[pos_idxs[:, 0]], env.y[pos_idxs[:, 1]], env.z[pos_idxs[:, 2]]]).T
+            np.testing.assert_allclose(pl.conc_at(centers), pl.conc_at_idxs(pos_idxs), rtol=1e-12)
+
+    def test_sample_at_uses_interpolated_conc(self):
+        positions = np.random.uniform([-0.3, -0.15, -0.15], [1.0, 0.15, 0.15], (500, 3))
+
+        pl = plume.CollimatedPlume(self.env)
+        pl.set_params(max_conc=250, threshold=200, ymean=0, zmean=0, ystd=.05, zstd=.05)
+        pl.initialize()
+        np.testing.assert_array_equal(pl.sample_at(positions), (pl.conc_at(positions) > 200).astype(int))
+
+        pl_0 = plume.CollimatedPoissonPlume(self.env, seed=0)
+        pl_1 = plume.CollimatedPoissonPlume(self.env, seed=0)
+        for pl in (pl_0, pl_1):
+            pl.set_aux_params(width=.01, peak=100, max_hit_number=1)
+            pl.set_src_pos((0., 0., 0.))
+            pl.initialize()
+
+        np.testing.assert_array_equal(pl_0.sample_at(positions, dt=.1), pl_1.poisson_hits(pl_1.conc_at(positions) * .1))
+
+
+class FieldCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 27)
+        ybins = np.linspace(-0.15, 0.15, 11)
+        zbins = np.linspace(-0.15, 0.15, 11)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def make_plume(self, r=10):
+        pl = plume.BasicPlume(self.env)
+        pl.set_params(w=0.4, r=r, d=0.1, a=.002, tau=1000)
+        pl.set_src_pos((0., 0., 0.))
+        return pl
+
+    def test_cached_field_matches_initialized_field(self):
+        cache = field_cache.FieldCache(self.tmp_dir.name)
+
+        pl = self.make_plume()
+        pl.initialize()
+
+        # first call calculates the field, second loads it
+        pl_0 = cache.initialize(self.make_plume())
+        pl_1 = cache.initialize(self.make_plume())
+
+        for pl_cached in (pl_0, pl_1):
+            self.assertIsInstance(pl_cached.conc, np.memmap)
+            self.assertFalse(pl_cached.conc.flags.writeable)
+            np.testing.assert_array_equal(pl_cached.mean_hit_rate, pl.mean_hit_rate)
+
+        pos_idxs = np.array([[13, 5, 5], [20, 5, 6]])
+        self.assertEqual(pl_1.sample_many(pos_idxs).shape, (2,))
+
+        # different params should give a different key
+        self.assertNotEqual(cache.key(self.make_plume()), cache.key(self.make_plume(r=20)))
+        self.assertEqual(len(os.listdir(self.tmp_dir.name)), 1)
+
+    def test_sparse_storage_is_not_cached(self):
+        cache = field_cache.FieldCache(self.tmp_dir.name)
+
+        pl_box = self.make_plume()
+        pl_box.set_storage('box', tol=1.)
+        self.assertNotEqual(cache.key(pl_box), cache.key(self.make_plume()))
+
+        pl_box = cache.initialize(pl_box)
+        self.assertIsInstance(pl_box.conc, plume.sparse_field.BoxField)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+        # a dense plume with the same params gets the exact field
+        pl = self.make_plume()
+        pl.initialize()
+        np.testing.assert_array_equal(cache.initialize(self.make_plume()).conc, pl.conc)
+
+    def test_analytic_fields_are_not_evaluated(self):
+        cache = field_cache.FieldCache(self.tmp_dir.name)
+
+        pl = self.make_plume()
+        pl.set_storage('analytic')
+        pl = cache.initialize(pl)
+        self.assertIsInstance(pl.conc, plume.sparse_field.AnalyticField)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+        with self.assertRaises(ValueError):
+            cache.save(cache.key(pl), pl.conc)
+
+    def test_plumes_without_static_fields_are_not_cached(self):
+        cache = field_cache.FieldCache(self.tmp_dir.name)
+
+        pl = plume.PuffPlume(self.env, seed=0)
+        pl.set_params(w=0.4, release_rate=500, q=1, d=0.0001, sigma_0=.01, wander=0.0005, max_puffs=1000)
+        pl.set_src_pos((0., 0., 0.))
+        pl = cache.initialize(pl)
+
+        self.assertIsNone(pl.conc)
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+        pl.update()
+        self.assertEqual(pl.sample_many(np.zeros((5, 3), dtype=int)).shape, (5,))
+
+        with self.assertRaises(ValueError):
+            cache.save(cache.key(pl), None)
+
+    def test_least_recently_used_fields_are_evicted(self):
+        field_bytes = int(np.prod(self.env.shape)) * 8
+        cache = field_cache.FieldCache(self.tmp_dir.name, max_bytes=int(2.5 * field_bytes))
+
+        keys = []
+        for r in (10, 20, 30):
+            pl = cache.initialize(self.make_plume(r=r))
+            keys += [cache.key(pl)]
+
+        # only the two most recently used fields fit
+        self.assertIsNone(cache.load(keys[0]))
+        self.assertIsNotNone(cache.load(keys[1]))
+        self.assertIsNotNone(cache.load(keys[2]))
+
+
+class BatchedSamplingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 27)
+        ybins = np.linspace(-0.15, 0.15, 11)
+        zbins = np.linspace(-0.15, 0.15, 11)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.pos_idxs = np.array([np.random.randint(0, n, (300,)) for n in self.env.shape]).T
+
+    def test_threshold_plumes_match_scalar_sampling(self):
+
+        pl_collimated = plume.CollimatedPlume(self.env)
+        pl_collimated.set_params(max_conc=250, threshold=200, ymean=0, zmean=0, ystd=.05, zstd=.05)
+
+        pl_spreading = plume.SpreadingGaussianPlume(self.env)
+        pl_spreading.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                                alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                                x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                                bkgd=400, threshold=450)
+
+        for pl in (pl_collimated, pl_spreading, plume.EmptyPlume(self.env)):
+            pl.initialize()
+
+            odors = pl.sample_many(self.pos_idxs)
+            true_odors = np.array([pl.sample(pos_idx) for pos_idx in self.pos_idxs])
+
+            np.testing.assert_array_equal(odors, true_odors)
+
+    def test_detection_maps_match_thresholded_fields(self):
+        # 2D environment, so that the number of voxels isn't a multiple of 8
+        env_2d = plume.Environment3d(np.linspace(-0.3, 1.0, 28), np.linspace(-0.15, 0.15, 12), np.array([-0.01, 0.01]))
+
+        for env in (self.env, env_2d):
+            pl = plume.SpreadingGaussianPlume(env)
+            pl.set_params(Q=-0.26618286981003886, u=0.4, u_star=0.06745668765535813,
+                          alpha_y=-0.066842568000323691, alpha_z=0.14538827993452938,
+                          x_source=-0.64790143304753445, y_source=.003, z_source=.011,
+                          bkgd=400, threshold=450)
+            pl.initialize()
+
+            n_voxels = int(np.prod(env.shape))
+            all_pos_idxs = np.array(np.unravel_index(np.arange(n_voxels), env.shape)).T
+            self.assertEqual(pl.detection_map.nbytes, -(-n_voxels // 8))
+
+            for threshold in (450, 600, 400, -1):
+                pl.set_params(threshold=threshold)
+                true_odors = (pl.conc.ravel() > threshold).astype(int) if threshold >= 0 else 0
+
+                np.testing.assert_array_equal(pl.sample_many(all_pos_idxs), true_odors)
+
+            pl.set_params(threshold=450)
+            odors = pl.sample_many(all_pos_idxs)
+
+            # idxs are interpreted like indices into conc
+            negative_idxs = all_pos_idxs[::7] - np.array(env.shape)
+            np.testing.assert_array_equal(pl.sample_many(negative_idxs), odors[::7])
+            self.assertEqual(pl.sample((-1, 5, -1)), int(pl.conc[-1, 5, -1] > 450))
+            for bad_idx in ((env.nx, 0, 0), (0, -env.ny - 1, 0)):
+                with self.assertRaises(IndexError):
+                    pl.sample(bad_idx)
+                with self.assertRaises(IndexError):
+                    pl.sample_many([bad_idx])
+
+            pl.drop_field()
+
+            self.assertIsNone(pl.conc)
+            np.testing.assert_array_equal(pl.sample_many(all_pos_idxs), odors)
+            with self.assertRaises(ValueError):
+                pl.set_params(threshold=500)
+
+    def test_basic_plume_matches_scalar_sampling(self):
+
+        pl = plume.BasicPlume(self.env, dt=.1)
+        pl.set_params(w=0.4, r=1000, d=0.1, a=.002, tau=1000)
+        pl.set_src_pos((0., 0., 0.))
+        pl.initialize()
+
+        # include the source voxel, where the mean hit rate is infinite
+        pos_idxs = np.concatenate([self.pos_idxs, [pl.src_pos_idx]])
+
+        for max_hit_number in (1, 5):
+            pl.max_hit_number = max_hit_number
+
+            pl.set_seed(0)
+            odors = pl.sample_many(pos_idxs)
+            pl.set_seed(0)
+            true_odors = np.array([pl.sample(pos_idx) for pos_idx in pos_idxs])
+
+            np.testing.assert_array_equal(odors, true_odors)
+            self.assertEqual(odors[-1], max_hit_number)
+
+    def test_seeded_plumes_are_reproducible_and_independent(self):
+
+        pos_idxs = np.tile([13, 5, 5], (1000, 1))
+
+        def make_plume(seed):
+            pl = plume.BasicPlume(self.env, dt=.1, seed=seed)
+            pl.set_params(w=0.4, r=1000, d=0.1, a=.002, tau=1000)
+            pl.set_src_pos((0., 0., 0.))
+            pl.initialize()
+            pl.max_hit_number = 100
+            return pl
+
+        seeds = plume.spawn_seeds(12345, 2)
+
+        odors_0 = make_plume(seeds[0]).sample_many(pos_idxs)
+        odors_1 = make_plume(seeds[1]).sample_many(pos_idxs)
+
+        # same seeds give identical results
+        np.testing.assert_array_equal(odors_0, make_plume(plume.spawn_seeds(12345, 2)[0]).sample_many(pos_idxs))
+        # different child streams give different results
+        self.assertFalse(np.all(odors_0 == odors_1))
+
+        # global random state has no effect
+        np.random.seed(0)
+        odors_2 = make_plume(7).sample_many(pos_idxs)
+        np.random.seed(0)
+        np.random.poisson(5, 10)
+        np.testing.assert_array_equal(odors_2, make_plume(7).sample_many(pos_idxs))
+
+
+class PuffPlumeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 53)
+        ybins = np.linspace(-0.15, 0.15, 13)
+        zbins = np.linspace(-0.15, 0.15, 13)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+    def make_plume(self, env, max_puffs=100000):
+        pl = plume.PuffPlume(env, dt=.01, seed=0)
+        pl.set_params(w=0.4, release_rate=500, q=1, d=0.0001, sigma_0=.01, wander=0.0005, max_puffs=max_puffs)
+        pl.set_src_pos((0., 0., 0.))
+        pl.initialize()
+        return pl
+
+    def test_puffs_advect_downwind_and_leave(self):
+        pl = self.make_plume(self.env)
+
+        for _ in range(100):
+            pl.update()
+
+        pos, var = pl.puffs
+        self.assertGreater(pl.n_puffs, 0)
+        # oldest puffs were released in the first update and have traveled about w * t downwind
+        self.assertAlmostEqual(pos[0, 0], 0.4 * 99 * .01, delta=.05)
+        np.testing.assert_allclose(var[0], .01**2 + 2 * 0.0001 * 99 * .01)
+
+        # after enough time, puffs should start leaving the environment
+        for _ in range(300):
+            pl.update()
+        self.assertLess(pl.puffs[0][:, 0].min(), 1.0)
+        self.assertLess(pl.n_puffs, 500 * 400 * .01)
+
+    def test_max_puffs_is_respected(self):
+        pl = self.make_plume(self.env, max_puffs=50)
+
+        for _ in range(50):
+            pl.update()
+
+        self.assertEqual(pl.n_puffs, 50)
+        # newest puffs are the ones kept (about 5 are released per update)
+        self.assertEqual(pl.puffs[1][-1], .01**2)
+        self.assertLess(pl.puffs[1][0], .01**2 + 2 * 0.0001 * .01 * 20)
+
+    def test_rasterized_field_matches_pointwise_conc(self):
+        for env in (self.env, plume.Environment3d(self.env.xbins, self.env.ybins, np.array([-.01, .01]))):
+            pl = self.make_plume(env)
+            # nothing is rasterized until asked for
+            self.assertIsNone(pl.conc)
+
+            for _ in range(50):
+                pl.update()
+
+            pos_idxs = np.array([np.random.randint(0, n, (100,)) for n in env.shape]).T
+            pos_idxs[:10] = pl.src_pos_idx
+
+            conc = pl.conc_at_idxs(pos_idxs)
+            np.testing.assert_allclose(pl.rasterize()[tuple(pos_idxs.T)], conc, rtol=1e-8, atol=1e-12 * conc.max())
+            self.assertEqual(pl.concxy.shape, (env.nx, env.ny))
+
+            odors = pl.sample_many(pos_idxs)
+            self.assertEqual(odors.shape, (100,))
+            self.assertTrue(np.all(odors[:10] == 1))
+
+
+class SearcherPopulationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 27)
+        ybins = np.linspace(-0.15, 0.15, 11)
+        zbins = np.linspace(-0.15, 0.15, 11)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        # make plume centered on source
+        self.pl = plume.CollimatedPlume(self.env)
+        self.pl.set_src_pos((0., 0., 0.))
+        self.pl.set_params(max_conc=250, threshold=200, ymean=self.pl.srcy, zmean=self.pl.srcz, ystd=.05, zstd=.05)
+        self.pl.initialize()
+
+    def test_population_matches_one_searcher_at_a_time(self):
+
+        def upwind_rule(population, odors):
+            return np.tile([-1, 0, 0], (len(odors), 1))
+
+        start_pos_idxs = np.array([np.random.randint(0, n, (200,)) for n in self.env.shape]).T
+
+        pop = searchers.SearcherPopulation(self.pl, 200, 40, rule=upwind_rule, record_positions=True)
+        pop.reset(start_pos_idxs)
+        pop.run()
+
+        for agent, pos_idx in enumerate(start_pos_idxs):
+            pos_idx = pos_idx.copy()
+            for ts in range(40):
+                if tuple(pos_idx) == self.pl.src_pos_idx:
+                    self.assertEqual(pop.found_ts[agent], ts)
+                    break
+
+                self.assertEqual(pop.odor_history[ts, agent], self.pl.sample(pos_idx))
+                np.testing.assert_array_equal(pop.pos_history[ts, agent], pos_idx)
+
+                pos_idx[0] -= 1
+                if self.env.idx_out_of_bounds(pos_idx):
+                    self.assertEqual(pop.exit_ts[agent], ts)
+                    break
+
+            # nothing is recorded once a searcher is inactive
+            self.assertTrue(np.all(pop.odor_history[ts + 1:, agent] == -1))
+
+        self.assertFalse(pop.active.any())
+
+    def test_surge_cast_finds_source_along_centerline(self):
+        n_agents = 2000
+        start_pos_idx = (20, self.pl.srcyidx, self.pl.srczidx)
+
+        found_fractions = []
+        for rule in (searchers.random_walk_rule, searchers.surge_cast_rule):
+            pop = searchers.SearcherPopulation(self.pl, n_agents, 200, rule=rule, seed=0)
+            pop.reset(start_pos_idx)
+            pop.run()
+
+            self.assertEqual(pop.odor_history.shape, (200, n_agents))
+            found_fractions += [np.mean(pop.found_ts >= 0)]
+
+        # surging searchers detect odor all along the plume's centerline, so they go
+        # straight to the source
+        self.assertLess(found_fractions[0], 0.5)
+        self.assertEqual(found_fractions[1], 1.)
+        self.assertTrue(np.all(pop.found_ts == 20 - self.pl.srcxidx))
+
+
+class SweepTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 27)
+        ybins = np.linspace(-0.15, 0.15, 11)
+        zbins = np.linspace(-0.15, 0.15, 11)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.pos_idxs = np.array([np.random.randint(0, n, (500,)) for n in self.env.shape]).T
+        self.param_points = sweep.param_grid(plume_name=['basic'], w=[0.2, 0.4], r=[10, 100], d=[0.1],
+                                             a=[.002], tau=[1000])
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_sweep_matches_serial_results(self):
+        results = dict((sweep.params_key(params), result) for params, result in
+                       sweep.run_sweep(sweep.plume_sampling_task, self.param_points, self.env,
+                                       shared_arrays={'pos_idxs': self.pos_idxs}, max_workers=2))
+
+        self.assertEqual(len(results), 4)
+        for params in self.param_points:
+            true_result = sweep.plume_sampling_task(self.env, {'pos_idxs': self.pos_idxs}, **params)
+            self.assertEqual(results[sweep.params_key(params)], true_result)
+
+    def test_sweep_resumes_from_results_file(self):
+        results_path = os.path.join(self.tmp_dir.name, 'results.jsonl')
+
+        # run only part of the sweep, then the whole thing
+        first = list(sweep.run_sweep(sweep.plume_sampling_task, self.param_points[:3], self.env,
+                                     results_path=results_path, max_workers=2))
+        second = list(sweep.run_sweep(sweep.plume_sampling_task, self.param_points, self.env,
+                                      results_path=results_path, max_workers=2))
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual([params for params, _ in second], self.param_points[3:])
+        self.assertEqual(len(sweep.load_results(results_path)), 4)
+
+
+    def test_numpy_params_and_per_point_seeds(self):
+        results_path = os.path.join(self.tmp_dir.name, 'results.jsonl')
+        param_points = sweep.param_grid(plume_name=['basic'], w=np.linspace(0.2, 0.4, 2), r=np.arange(10, 30, 10),
+                                        d=[0.1], a=[.002], tau=[1000], n_samples=[20000])
+
+        results = list(sweep.run_sweep(sweep.plume_sampling_task, param_points, self.env,
+                                       results_path=results_path, max_workers=2))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(sweep.load_results(results_path)), 4)
+
+        # each point gets its own (reproducible) seed
+        seeds = [sweep.point_seed(params).generate_state(2).tolist() for params in param_points]
+        self.assertEqual(len(set(map(tuple, seeds))), 4)
+        self.assertEqual(sweep.point_seed(param_points[0]).generate_state(2).tolist(), seeds[0])
+
+
 class DiscretizationTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -213,6 +1080,245 @@ class DiscretizationTestCase(unittest.TestCase):
             np.testing.assert_array_equal(first_pos_idx_env, np.array(pos_idxs[0]))
             np.testing.assert_array_equal(last_pos_idx_env, np.array(pos_idxs[-1]))
 
+    def test_discretization_matches_stepwise_reference(self):
+
+        for step_std in (.003, .03, .2):
+
+            x = 0.5 + np.random.normal(0, step_std, (300,)).cumsum()
+            y = 0.5 + np.random.normal(0, step_std, (300,)).cumsum()
+            z = 0.5 + np.random.normal(0, step_std, (300,)).cumsum()
+            positions = np.array([x, y, z]).T
+
+            # build reference path one step at a time
+            true_pos_idxs = [np.array(self.env.idx_from_pos(positions[0]))]
+            for pos in positions[1:]:
+                pos_idx = np.array(self.env.idx_from_pos(pos))
+                if np.abs(pos_idx - true_pos_idxs[-1]).sum() > 0:
+                    true_pos_idxs += list(self.env.diagonalest_lattice_path(true_pos_idxs[-1], pos_idx))
+
+            pos_idxs = self.env.discretize_position_sequence(positions)
+
+            self.assertEqual(pos_idxs.shape, (len(true_pos_idxs), 3))
+            np.testing.assert_array_equal(pos_idxs, np.array(true_pos_idxs))
+
+    def test_chunked_discretization_matches_batch(self):
+
+        x = 0.5 + np.random.normal(0, .03, (500,)).cumsum()
+        y = 0.5 + np.random.normal(0, .03, (500,)).cumsum()
+        z = 0.5 + np.random.normal(0, .03, (500,)).cumsum()
+        positions = np.array([x, y, z]).T
+
+        # split into chunks of random sizes, including an empty one
+        split_idxs = np.sort(np.random.randint(0, 500, (20,)))
+        chunks = np.split(positions, np.concatenate([split_idxs[:5], [split_idxs[5]] * 2, split_idxs[6:]]))
+
+        pos_idxs = np.concatenate(list(self.env.discretize_position_chunks(chunks)))
+
+        np.testing.assert_array_equal(pos_idxs, self.env.discretize_position_sequence(positions))
+
+
+class AdvectionDiffusionKernelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'dt': .1, 'w': 0.4, 'r': 10, 'd': 0.1, 'a': .002, 'tau': 1000}
+
+    def test_cached_kernel_matches_direct_calculation(self):
+        xext = np.linspace(-0.3, 1.0, 14)
+        yext = np.linspace(-0.15, 0.15, 7)
+
+        for zext in (np.linspace(-0.15, 0.15, 5), np.array([0.])):
+            for pos_idx in ((0, 0, 0), (13, 6, len(zext) - 1), (5, 2, 0)):
+                for odor in (0, 1):
+                    lp = logprob_odor.binary_advec_diff_tavg_cached(odor, pos_idx, xext, yext, zext, **self.params)
+                    true_lp = logprob_odor.binary_advec_diff_tavg(odor, pos_idx, xext, yext, zext, **self.params)
+
+                    self.assertEqual(lp.shape, true_lp.shape)
+                    np.testing.assert_allclose(lp, true_lp, rtol=1e-8)
+
+    def test_kernel_is_cached_and_read_only(self):
+        xext = np.linspace(-0.3, 1.0, 14)
+        yext = np.linspace(-0.15, 0.15, 7)
+        zext = np.linspace(-0.15, 0.15, 5)
+
+        lp_0 = logprob_odor.binary_advec_diff_tavg_cached(1, (3, 3, 3), xext, yext, zext, **self.params)
+        lp_1 = logprob_odor.binary_advec_diff_tavg_cached(1, (4, 3, 3), xext, yext, zext, **self.params)
+
+        # both should be views into the same kernel
+        self.assertTrue(np.shares_memory(lp_0, lp_1))
+        self.assertFalse(lp_0.flags.writeable)
+
+    def test_kernel_cache_is_bounded_by_bytes(self):
+        xext = np.linspace(-0.3, 1.0, 14)
+        yext = np.linspace(-0.15, 0.15, 7)
+        zext = np.linspace(-0.15, 0.15, 5)
+        kernel_bytes = 2 * 27 * 13 * 9 * 8
+
+        max_bytes = logprob_odor.kernel_cache_max_bytes
+        logprob_odor.kernel_cache_max_bytes = int(2.5 * kernel_bytes)
+        self.addCleanup(setattr, logprob_odor, 'kernel_cache_max_bytes', max_bytes)
+        logprob_odor.evict_kernels(0)
+
+        for r in (10, 20, 30):
+            logprob_odor.binary_advec_diff_tavg_cached(1, (3, 3, 3), xext, yext, zext, **dict(self.params, r=r))
+
+        # only the two most recently used kernels fit
+        self.assertEqual([key[4] for key in logprob_odor._kernel_cache], [20, 30])
+
+    def test_single_precision_kernel_is_built_in_single_precision(self):
+        tracemalloc.start()
+        try:
+            kernel = logprob_odor.BinaryAdvecDiffKernel((100, 40, 40), (.01, .01, .01), dtype=np.float32,
+                                                        **self.params)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(kernel.lhit.dtype, np.float32)
+        self.assertLess(peak, 1.2 * kernel.nbytes)
+
+    def test_logk0_matches_scipy_and_asymptotic_expansion(self):
+        from scipy.special import k0
+
+        x = np.logspace(-300, np.log10(700), 1000)
+        np.testing.assert_allclose(logprob_odor.logk0(x), np.log(k0(x)), rtol=1e-13)
+
+        # where k0 underflows, compare to log of the large-x expansion of k0
+        x = np.logspace(3, 8, 100)
+        expansion = 0.5 * np.log(np.pi / (2 * x)) - x + np.log1p(-1 / (8 * x) + 9 / (128 * x**2))
+        np.testing.assert_allclose(logprob_odor.logk0(x), expansion, rtol=1e-13)
+
+        self.assertEqual(logprob_odor.logk0(0.), np.inf)
+
+    def test_fused_log_probs_match_naive_calculation(self):
+        dx, dy, dz = np.meshgrid(np.linspace(-0.3, 1.0, 27), np.linspace(-0.15, 0.15, 13),
+                                 np.linspace(-0.15, 0.15, 9), indexing='ij', sparse=True)
+        p = self.params
+
+        for dim, dz_ in ((3, dz), (2, np.zeros((1, 1, 1)))):
+            mean_hit_num = p['dt'] * logprob_odor.advec_diff_mean_hit_rate(
+                dx, dy, dz_, p['w'], p['r'], p['d'], p['a'], p['tau'], dim=dim)
+            true_lhit, true_lmiss = logprob_odor.binary_log_probs(mean_hit_num)
+
+            log_rate = logprob_odor.log_advec_diff_mean_hit_rate(
+                dx, dy, dz_, p['w'], p['r'], p['d'], p['a'], p['tau'], dim=dim)
+            with np.errstate(divide='ignore'):
+                np.testing.assert_allclose(log_rate, np.log(mean_hit_num / p['dt']), rtol=1e-10)
+
+            lhit = np.empty(log_rate.shape)
+            lmiss = np.empty(log_rate.shape)
+            lhit_, lmiss_ = logprob_odor.binary_advec_diff_log_probs(
+                dx, dy, dz_, dim=dim, lhit=lhit, lmiss=lmiss, **p)
+
+            # results should be written into the given buffers
+            self.assertIs(lhit_, lhit)
+            self.assertIs(lmiss_, lmiss)
+
+            np.testing.assert_allclose(lhit, true_lhit, rtol=1e-8)
+            np.testing.assert_allclose(lmiss, true_lmiss, rtol=1e-8, atol=1e-300)
+
+    def test_fused_hit_log_prob_is_finite_for_tiny_mean_hit_numbers(self):
+        p = self.params
+        # far enough upwind that the mean hit number underflows in linear space
+        dx = np.array([-10., -200., -500.])
+
+        lhit, lmiss = logprob_odor.binary_advec_diff_log_probs(dx, 0., 0., **p)
+        log_mean_hit_num = np.log(p['dt']) + logprob_odor.log_advec_diff_mean_hit_rate(
+            dx, 0., 0., p['w'], p['r'], p['d'], p['a'], p['tau'])
+
+        self.assertTrue(np.all(log_mean_hit_num < -40))
+        self.assertTrue(np.all(np.isfinite(lhit)))
+        np.testing.assert_allclose(lhit, log_mean_hit_num, rtol=1e-12)
+
+
+class SourcePosteriorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        xbins = np.linspace(-0.3, 1.0, 14)
+        ybins = np.linspace(-0.15, 0.15, 7)
+        zbins = np.linspace(-0.15, 0.15, 6)
+        self.env = plume.Environment3d(xbins, ybins, zbins)
+
+        self.params = {'dt': .1, 'w': 0.4, 'r': 100, 'd': 0.1, 'a': .002, 'tau': 1000}
+
+        self.pos_idxs = np.array([np.random.randint(0, n, (40,)) for n in self.env.shape]).T
+        # repeat some observations to exercise update_many's grouping
+        self.pos_idxs = np.concatenate([self.pos_idxs, self.pos_idxs[:10]])
+        self.odors = np.random.randint(0, 2, (len(self.pos_idxs),))
+
+    def test_posterior_matches_summed_log_likelihoods(self):
+
+        odors = self.odors
+
+        log_post = np.zeros(self.env.shape)
+        for pos_idx, odor in zip(self.pos_idxs, odors):
+            log_post += logprob_odor.binary_advec_diff_tavg(odor, pos_idx, self.env.x, self.env.y, self.env.z,
+                                                            **self.params)
+        true_post = np.exp(log_post - log_post.max())
+        true_post /= true_post.sum()
+
+        sp = logprob_odor.SourcePosterior(self.env, **self.params)
+        for pos_idx, odor in zip(self.pos_idxs, odors):
+            sp.update(pos_idx, odor)
+
+        np.testing.assert_allclose(sp.posterior, true_post, rtol=1e-6, atol=1e-12)
+        self.assertEqual(sp.map_idx, np.unravel_index(np.argmax(true_post), self.env.shape))
+
+        nonzero = true_post > 0
+        true_entropy = -np.sum(true_post[nonzero] * np.log(true_post[nonzero]))
+        self.assertAlmostEqual(sp.entropy, true_entropy, places=6)
+
+    def test_update_many_matches_sequential_updates(self):
+
+        sp_0 = logprob_odor.SourcePosterior(self.env, **self.params)
+        for pos_idx, odor in zip(self.pos_idxs, self.odors):
+            sp_0.update(pos_idx, odor)
+
+        sp_1 = logprob_odor.SourcePosterior(self.env, **self.params)
+        sp_1.update_many(self.pos_idxs, self.odors)
+
+        np.testing.assert_allclose(sp_1.posterior, sp_0.posterior, rtol=1e-6, atol=1e-12)
+        self.assertEqual(sp_0.n_obs, sp_1.n_obs)
+
+    def test_fft_log_likelihood_matches_summed_log_likelihoods(self):
+
+        for zbins in (self.env.zbins, np.array([-0.01, 0.01])):
+            env = plume.Environment3d(self.env.xbins, self.env.ybins, zbins)
+            pos_idxs = self.pos_idxs.copy()
+            pos_idxs[:, 2] = np.minimum(pos_idxs[:, 2], env.nz - 1)
+
+            true_log_like = np.zeros(env.shape)
+            for pos_idx, odor in zip(pos_idxs, self.odors):
+                true_log_like += logprob_odor.binary_advec_diff_tavg(odor, pos_idx, env.x, env.y, env.z,
+                                                                     **self.params)
+
+            hit_counts, miss_counts = logprob_odor.hit_miss_counts(pos_idxs, self.odors, env.shape)
+            self.assertEqual(hit_counts.sum() + miss_counts.sum(), len(self.odors))
+
+            log_like = logprob_odor.binary_advec_diff_tavg_fft(hit_counts, miss_counts, env.x, env.y, env.z,
+                                                               **self.params)
+
+            # impossible source positions (e.g. where a miss was observed) should match exactly
+            np.testing.assert_array_equal(np.isneginf(log_like), np.isneginf(true_log_like))
+            np.testing.assert_allclose(log_like, true_log_like, rtol=1e-6, atol=1e-6)
+
+    def test_update_counts_matches_update_many(self):
+
+        sp_0 = logprob_odor.SourcePosterior(self.env, **self.params)
+        sp_0.update_many(self.pos_idxs, self.odors)
+
+        sp_1 = logprob_odor.SourcePosterior(self.env, **self.params)
+        sp_1.update_counts(*logprob_odor.hit_miss_counts(self.pos_idxs, self.odors, self.env.shape))
+
+        np.testing.assert_allclose(sp_1.posterior, sp_0.posterior, rtol=1e-6, atol=1e-12)
+        self.assertEqual(sp_0.n_obs, sp_1.n_obs)
+
+    def test_uniform_posterior_entropy(self):
+
+        sp = logprob_odor.SourcePosterior(self.env, **self.params)
+
+        self.assertAlmostEqual(sp.entropy, np.log(np.prod(self.env.shape)))
+        np.testing.assert_allclose(sp.posterior.sum(), 1.)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file